@@ -11,15 +11,41 @@ import numpy as np
 import json
 import datetime
 from datetime import timezone
-import pytz  # For Malaysia timezone (GMT+8)
+from enum import IntEnum
+from zoneinfo import ZoneInfo  # For Malaysia timezone (GMT+8)
 import re
+import sys
 import hashlib
 import time
 import random
 import requests
+import logging
+import copy
+import itertools
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def debug_enabled():
+    """True when DEBUG is switched on in Streamlit secrets"""
+    try:
+        return bool(st.secrets.get('DEBUG', False))
+    except Exception:
+        return False
+
+# App logger; verbose request tracing only when DEBUG is set
+log = logging.getLogger('mindbridge')
+if not log.handlers:
+    log.addHandler(logging.StreamHandler())
+log.setLevel(logging.DEBUG if debug_enabled() else logging.WARNING)
 
 # Malaysia timezone
-MALAYSIA_TZ = pytz.timezone('Asia/Kuala_Lumpur')
+MALAYSIA_TZ = ZoneInfo('Asia/Kuala_Lumpur')
+
+# Python 3.11+ parses a trailing 'Z' in fromisoformat natively
+FROMISOFORMAT_HANDLES_Z = sys.version_info >= (3, 11)
 
 def get_malaysia_time():
     """Get current time in Malaysia timezone (GMT+8)"""
@@ -31,17 +57,369 @@ def format_malaysia_time(dt=None):
         dt = get_malaysia_time()
     elif isinstance(dt, str):
         # Parse ISO string and convert to Malaysia time
-        dt = datetime.datetime.fromisoformat(dt.replace('Z', '+00:00'))
+        if not FROMISOFORMAT_HANDLES_Z and dt.endswith('Z'):
+            dt = dt[:-1] + '+00:00'
+        dt = datetime.datetime.fromisoformat(dt)
         dt = dt.astimezone(MALAYSIA_TZ)
     return dt.strftime('%Y-%m-%d %H:%M:%S %Z')
 
+def split_timestamp(timestamp):
+    """(date, HH:MM) parts of a stored ISO timestamp string"""
+    date_str, separator, rest = timestamp.partition('T')
+    if not separator:
+        return timestamp[:10], timestamp[11:16]
+    return date_str, rest[:5]
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
 try:
-    import plotly.express as px
-    import plotly.graph_objects as go
-    PLOTLY_AVAILABLE = True
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
 except ImportError:
-    PLOTLY_AVAILABLE = False
-    st.warning("Plotly not available. Charts will be disabled.")
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+def _summarize_sessions(sentiment, depression, anxiety):
+    """One pass over the session columns: sentiment mean/min/max, indicator mean/max"""
+    n = sentiment.size
+    s_sum = 0.0
+    s_min = sentiment[0]
+    s_max = sentiment[0]
+    d_sum = 0
+    d_max = depression[0]
+    a_sum = 0
+    a_max = anxiety[0]
+    for i in range(n):
+        s = sentiment[i]
+        s_sum += s
+        if s < s_min:
+            s_min = s
+        if s > s_max:
+            s_max = s
+        d_sum += depression[i]
+        if depression[i] > d_max:
+            d_max = depression[i]
+        a_sum += anxiety[i]
+        if anxiety[i] > a_max:
+            a_max = anxiety[i]
+    return s_sum / n, s_min, s_max, d_sum / n, d_max, a_sum / n, a_max
+
+def _summarize_sessions_numpy(sentiment, depression, anxiety):
+    """Reduction-per-column equivalent of _summarize_sessions for when Numba is missing"""
+    return (
+        sentiment.mean(dtype=np.float64), sentiment.min(), sentiment.max(),
+        depression.mean(), depression.max(),
+        anxiety.mean(), anxiety.max()
+    )
+
+SESSION_STAT_FIELDS = (
+    'sentiment_mean', 'sentiment_min', 'sentiment_max',
+    'depression_mean', 'depression_max',
+    'anxiety_mean', 'anxiety_max'
+)
+
+# Below this many sessions the NumPy reductions finish long before a JIT compile would
+SESSION_STATS_JIT_MIN_ROWS = 50_000
+
+@st.cache_resource(show_spinner=False)
+def load_session_stats_kernel():
+    """JIT-compile the analytics reduction once per process, reusing Numba's on-disk cache"""
+    if NUMBA_AVAILABLE:
+        return njit(cache=True)(_summarize_sessions)
+    return _summarize_sessions_numpy
+
+@st.cache_resource(show_spinner=False)
+def load_plotly():
+    """Import Plotly lazily; only the analytics dashboard draws charts"""
+    try:
+        import plotly.express as px
+        return px
+    except ImportError:
+        return None
+
+@st.cache_resource(show_spinner=False)
+def load_embedder():
+    """Load the sentence embedding model once per process (None if unavailable)"""
+    if not SENTENCE_TRANSFORMERS_AVAILABLE:
+        return None
+    try:
+        return SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    except Exception as e:
+        log.warning("⚠️ Embedding model unavailable, semantic cache disabled: %s", e)
+        return None
+
+class GeminiEmbedder:
+    """Gemini embedding endpoint with the subset of the SentenceTransformer API the cache uses"""
+    
+    def __init__(self, session, api_key, dimensions=768, timeout=(2, 3)):
+        self.session = session
+        self.dimensions = dimensions
+        # Short: a slow embedding only costs the semantic tier a miss
+        self.timeout = timeout
+        self.url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-embedding-001:embedContent?key={api_key}"
+    
+    def encode(self, text, normalize_embeddings=True):
+        body = json_dumps({
+            "content": {"parts": [{"text": text}]},
+            "taskType": "SEMANTIC_SIMILARITY",
+            "outputDimensionality": self.dimensions
+        })
+        response = self.session.post(self.url, data=body, timeout=self.timeout)
+        response.raise_for_status()
+        vector = np.asarray(json_loads(response.content)['embedding']['values'], dtype=np.float32)
+        if normalize_embeddings:
+            # Truncated Gemini embeddings are not unit length
+            vector /= np.linalg.norm(vector) or 1.0
+        return vector
+
+class AnalysisCache:
+    """Two-tier cache for Gemini analyses: exact LRU plus embedding similarity
+    
+    Entries expire `ttl` seconds after they were stored in either tier. The
+    similarity tier only reuses an analysis made after the same preceding
+    exchange, so a similar message in a different conversation is a miss.
+    It is skipped for texts shorter than `min_semantic_chars`. Nothing is
+    embedded until a lookup finds a stored entry with the same context, so
+    turns that cannot hit never pay for an embedding round trip.
+    """
+    
+    def __init__(self, embedder=None, max_entries=1024, similarity_threshold=0.93, ttl=600,
+                 min_semantic_chars=40):
+        self.embedder = embedder
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.min_semantic_chars = min_semantic_chars
+        self._exact = OrderedDict()
+        # [context, text, vector or None until first needed, (expires, analysis)]
+        self._similar = []
+        self._last_query = (None, None)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(text, context=""):
+        normalized = text.lower().strip() + "\x1f" + context
+        return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def _semantic(self, text):
+        return self.embedder is not None and len(text) >= self.min_semantic_chars
+    
+    def _embed(self, text):
+        try:
+            vector = self.embedder.encode(text, normalize_embeddings=True)
+        except Exception as e:
+            # A failed embedding only costs the semantic tier, never the analysis
+            log.debug("Embedding failed, semantic cache skipped: %s", e)
+            return None
+        return np.asarray(vector, dtype=np.float32)
+    
+    def get(self, key, text, context=""):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is not None:
+                expires, analysis = entry
+                if expires > now:
+                    self._exact.move_to_end(key)
+                    return copy.deepcopy(analysis)
+                del self._exact[key]
+            if not self._semantic(text):
+                return None
+            candidates = [record for record in self._similar if record[0] == context and record[3][0] > now]
+        if not candidates:
+            return None
+        
+        query = self._embed(text)
+        if query is None:
+            return None
+        # A miss is followed by put() for the same text, which keeps this vector
+        self._last_query = (text, query)
+        for record in candidates:
+            if record[2] is None:
+                record[2] = self._embed(record[1])
+        candidates = [record for record in candidates if record[2] is not None]
+        if not candidates:
+            return None
+        # Vectors are unit-normalized, so the dot product is the cosine similarity
+        scores = np.stack([record[2] for record in candidates]) @ query
+        best = int(scores.argmax())
+        if scores[best] >= self.similarity_threshold:
+            return copy.deepcopy(candidates[best][3][1])
+        return None
+    
+    def put(self, key, text, analysis, context=""):
+        entry = (time.monotonic() + self.ttl, copy.deepcopy(analysis))
+        last_text, last_vector = self._last_query
+        with self._lock:
+            self._exact[key] = entry
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+            if self._semantic(text):
+                self._similar.append([context, text, last_vector if last_text == text else None, entry])
+                # FIFO eviction keeps the similarity tier bounded
+                if len(self._similar) > self.max_entries:
+                    del self._similar[0]
+
+class KeywordMatcher:
+    """Multi-keyword substring matcher that scans the text in a single pass
+    
+    Keywords match anywhere in the text (so "die" also flags "died"), the same
+    as `keyword in text` checks; the crisis override relies on that recall.
+    """
+    
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords)
+        self._automaton = None
+        if AHOCORASICK_AVAILABLE:
+            self._automaton = ahocorasick.Automaton()
+            for keyword in self.keywords:
+                self._automaton.add_word(keyword, keyword)
+            self._automaton.make_automaton()
+    
+    def findall(self, text_lower):
+        """Return every keyword hit in an already-lowercased text"""
+        if self._automaton is None:
+            return [keyword for keyword in self.keywords if keyword in text_lower]
+        return [keyword for _, keyword in self._automaton.iter(text_lower)]
+    
+    def count(self, text_lower):
+        """Number of distinct keywords present in an already-lowercased text"""
+        return len(set(self.findall(text_lower)))
+
+@st.cache_resource(show_spinner=False)
+def load_keyword_matcher(keywords):
+    """Build a KeywordMatcher (and its automaton) once per process per keyword tuple"""
+    return KeywordMatcher(keywords)
+
+class ThemeMatcher:
+    """Reports which themes have a keyword anywhere in the text, in one scan
+    
+    Keywords match as plain substrings (so "stress" also flags "stressed").
+    """
+    
+    def __init__(self, themes):
+        self.themes = tuple(name for name, _ in themes)
+        self._lookup = {}
+        for name, keywords in themes:
+            for keyword in keywords:
+                self._lookup.setdefault(keyword, []).append(name)
+        # The lookahead reports overlapping hits, like repeated `in` checks would
+        self._pattern = re.compile('(?=(' + '|'.join(map(re.escape, self._lookup)) + '))')
+        self._automaton = None
+        if AHOCORASICK_AVAILABLE:
+            self._automaton = ahocorasick.Automaton()
+            for keyword, names in self._lookup.items():
+                self._automaton.add_word(keyword, names)
+            self._automaton.make_automaton()
+    
+    def _hits(self, text_lower):
+        if self._automaton is None:
+            return (self._lookup[match.group(1)] for match in self._pattern.finditer(text_lower))
+        return (names for _, names in self._automaton.iter(text_lower))
+    
+    def themes_in(self, text_lower):
+        """Themes present in an already-lowercased text, in declaration order"""
+        found = set()
+        for names in self._hits(text_lower):
+            found.update(names)
+            if len(found) == len(self.themes):
+                break
+        return [name for name in self.themes if name in found]
+
+# Report themes and the keywords that flag them, in report order
+REPORT_THEMES = (
+    ("Depressive symptoms", ('sad', 'depressed', 'down', 'hopeless')),
+    ("Anxiety symptoms", ('anxious', 'worried', 'nervous', 'panic')),
+    ("Sleep disturbances", ('sleep', 'tired', 'fatigue', 'insomnia')),
+    ("Work-related stress", ('work', 'job', 'career', 'stress')),
+    ("Relationship concerns", ('family', 'relationship', 'partner'))
+)
+
+@st.cache_resource(show_spinner=False)
+def load_theme_matcher(themes):
+    """Build a ThemeMatcher (and its automaton) once per process per theme table"""
+    return ThemeMatcher(themes)
+
+# Invariant parts of the analysis prompt; only the context and message vary per call
+GEMINI_PROMPT_PREFIX = "You are a clinical mental health AI analyzer. Analyze this patient message for mental health indicators.\n\n"
+GEMINI_PROMPT_SUFFIX = """Analyze and return ONLY valid JSON (no markdown, no explanation):
+{
+    "sentiment_score": <float between -1.0 (very negative) and 1.0 (very positive)>,
+    "is_sarcastic": <true or false>,
+    "true_emotion": "<actual emotion if sarcastic, or 'none' if not>",
+    "depression_indicators": <integer count 0-10>,
+    "anxiety_indicators": <integer count 0-10>,
+    "crisis_indicators": <integer count 0-5>,
+    "risk_level": "<Critical or High or Medium or Low>",
+    "emotional_state": "<brief 5-10 word description>",
+    "key_concerns": ["<concern1>", "<concern2>"],
+    "confidence": <float between 0.0 and 1.0>
+}
+
+CRITICAL: Detect sarcasm ("I'm fine" when struggling), minimization, hidden emotions, and consider conversation context."""
+
+# Structured-output schema so Gemini returns bare JSON matching our analysis dict
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "sentiment_score": {"type": "NUMBER"},
+        "is_sarcastic": {"type": "BOOLEAN"},
+        "true_emotion": {"type": "STRING"},
+        "depression_indicators": {"type": "INTEGER"},
+        "anxiety_indicators": {"type": "INTEGER"},
+        "crisis_indicators": {"type": "INTEGER"},
+        "risk_level": {"type": "STRING", "enum": ["Critical", "High", "Medium", "Low"]},
+        "emotional_state": {"type": "STRING"},
+        "key_concerns": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "confidence": {"type": "NUMBER"}
+    },
+    "required": [
+        "sentiment_score", "is_sarcastic", "true_emotion", "depression_indicators",
+        "anxiety_indicators", "crisis_indicators", "risk_level", "emotional_state",
+        "key_concerns", "confidence"
+    ]
+}
+
+# Fields worth surfacing while a streamed analysis is still arriving
+PARTIAL_FIELD_RE = re.compile(r'"(risk_level|emotional_state)"\s*:\s*"([^"]*)"')
+
+# Rough prompt budget for conversation context (~4 characters per token)
+CONTEXT_TOKEN_BUDGET = 600
+
+# Trailing messages an analysis is cached under (the patient's last message and the reply)
+CACHE_CONTEXT_MESSAGES = 2
+
+def select_context_window(conversation_history, budget=CONTEXT_TOKEN_BUDGET):
+    """Newest messages that fit in the token budget, oldest first"""
+    kept = []
+    for message in reversed(conversation_history):
+        estimate = len(message['content']) // 4 + 4
+        if estimate > budget:
+            break
+        budget -= estimate
+        kept.append(message)
+    kept.reverse()
+    return kept
 
 # Gemini AI-Enhanced Sentiment Analysis
 class GeminiSentimentAnalyzer:
@@ -50,6 +428,7 @@ class GeminiSentimentAnalyzer:
     def __init__(self):
         # Always initialize fallback first (in case API fails)
         self._init_fallback()
+        self.cache = AnalysisCache(embedder=load_embedder())
         
         # Get API key from Streamlit secrets with better error handling
         self.api_key = None
@@ -58,24 +437,59 @@ class GeminiSentimentAnalyzer:
             if hasattr(st, 'secrets'):
                 if "GEMINI_API_KEY" in st.secrets:
                     self.api_key = st.secrets["GEMINI_API_KEY"]
-                    print(f"✅ Gemini API key found: {self.api_key[:20]}...")
+                    log.debug("✅ Gemini API key found: %.20s...", self.api_key)
                 else:
-                    print("❌ GEMINI_API_KEY not found in secrets")
-                    print(f"Available secrets: {list(st.secrets.keys())}")
+                    log.warning("❌ GEMINI_API_KEY not found in secrets")
+                    log.debug("Available secrets: %s", list(st.secrets.keys()))
             else:
-                print("❌ st.secrets not available")
+                log.warning("❌ st.secrets not available")
         except Exception as e:
-            print(f"❌ Error accessing secrets: {e}")
+            log.warning("❌ Error accessing secrets: %s", e)
             self.api_key = None
         
         if self.api_key and len(self.api_key) > 10:
-            self.api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={self.api_key}"
+            self.api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent?alt=sse&key={self.api_key}"
             self.use_fallback = False
-            print("✅ Gemini AI enabled with model: gemini-1.5-flash")
+            self.session = self._build_session()
+            if self.cache.embedder is None:
+                # Remote, but the cache only embeds when a stored entry could match
+                self.cache.embedder = GeminiEmbedder(self.session, self.api_key)
+            # Open the TLS connection in the background so the first message reuses it
+            threading.Thread(target=self._warm_connection, daemon=True).start()
+            log.debug("✅ Gemini AI enabled with model: gemini-2.0-flash")
         else:
             st.warning("⚠️ Gemini AI unavailable. Add GEMINI_API_KEY to Streamlit secrets for smart analysis.")
             self.use_fallback = True
-            print("⚠️ Using fallback analysis")
+            log.info("⚠️ Using fallback analysis")
+    
+    def _build_session(self):
+        """Pooled keep-alive HTTP session so repeat calls skip the TLS handshake"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(["GET", "POST"])
+            )
+        )
+        session.mount("https://", adapter)
+        session.headers.update({"Connection": "keep-alive", "Content-Type": "application/json"})
+        return session
+    
+    def _warm_connection(self):
+        """Cheap request that leaves a live keep-alive socket in the session pool"""
+        try:
+            self.session.get(
+                "https://generativelanguage.googleapis.com/v1beta/models",
+                params={"key": self.api_key, "pageSize": 1},
+                timeout=5
+            )
+            log.debug("🔥 Gemini connection warmed")
+        except Exception as e:
+            log.debug("Gemini warm-up failed: %s", e)
     
     def _init_fallback(self):
         """Simple fallback analyzer if no API key"""
@@ -93,52 +507,73 @@ class GeminiSentimentAnalyzer:
             'worthless', 'stress', 'stressed', 'overwhelmed', 'exhausted', 'nervous',
             'scared', 'fear', 'panic', 'crying', 'tired'
         ]
+        
+        # Hashed lookups and a single translate() pass for punctuation
+        self.positive_set = frozenset(self.positive_words)
+        self.negative_set = frozenset(self.negative_words)
+        self._strip_punctuation = str.maketrans('', '', '.,!?;:"\'')
     
-    def analyze_sentiment(self, text, conversation_history=None):
-        """Analyze with Gemini AI or fallback to simple method"""
+    def analyze_sentiment(self, text, conversation_history=None, on_partial=None, lowered=None):
+        """Analyze with Gemini AI or fallback to simple method
+        
+        `lowered` is text.lower() when the caller already has it.
+        """
         if self.use_fallback:
-            return self._simple_analysis(text)
+            return self._simple_analysis(text, lowered)
         
         try:
-            result = self._gemini_analysis(text, conversation_history)
-            st.sidebar.success("✅ Gemini AI worked!")
-            return result
+            return self._gemini_analysis(text, conversation_history, on_partial)
         except Exception as e:
             error_msg = str(e)
-            print(f"❌ GEMINI ERROR: {error_msg}")
+            log.warning("❌ GEMINI ERROR: %s", error_msg)
             st.sidebar.error(f"🚨 Gemini Failed: {error_msg[:200]}")
-            return self._simple_analysis(text)
-    
-    def _gemini_analysis(self, text, conversation_history=None):
+            return self._simple_analysis(text, lowered)
+    
+    def _read_stream(self, response, on_partial=None):
+        """Accumulate SSE text deltas, reporting key fields as soon as they complete"""
+        response.encoding = 'utf-8'
+        chunks = []
+        reported = {}
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            event = json_loads(line[5:])
+            for candidate in event.get('candidates', [])[:1]:
+                chunks.extend(part.get('text', '') for part in candidate.get('content', {}).get('parts', []))
+            
+            if on_partial is not None:
+                partial = dict(PARTIAL_FIELD_RE.findall("".join(chunks)))
+                if partial != reported:
+                    reported = partial
+                    on_partial(partial)
+        return "".join(chunks)
+    
+    def _gemini_analysis(self, text, conversation_history=None, on_partial=None):
         """Use Gemini AI for sophisticated analysis"""
         try:
-            # Build context from conversation history
+            # Build context from the conversation before this message
             context = ""
+            cache_context = ""
             if conversation_history:
-                recent = conversation_history[-5:]  # Last 5 messages
+                recent = select_context_window(conversation_history)
                 context = "\n".join([f"{m['role']}: {m['content']}" for m in recent])
+                # The cache only keys on the last exchange, so a repeat after the
+                # same reply can hit even though the full history keeps growing
+                tail = list(itertools.islice(reversed(conversation_history), CACHE_CONTEXT_MESSAGES))
+                cache_context = "\n".join([f"{m['role']}: {m['content']}" for m in reversed(tail)])
             
-            prompt = f"""You are a clinical mental health AI analyzer. Analyze this patient message for mental health indicators.
-
-{f"Previous conversation context:\n{context}\n" if context else ""}
-
-Current patient message: "{text}"
-
-Analyze and return ONLY valid JSON (no markdown, no explanation):
-{{
-    "sentiment_score": <float between -1.0 (very negative) and 1.0 (very positive)>,
-    "is_sarcastic": <true or false>,
-    "true_emotion": "<actual emotion if sarcastic, or 'none' if not>",
-    "depression_indicators": <integer count 0-10>,
-    "anxiety_indicators": <integer count 0-10>,
-    "crisis_indicators": <integer count 0-5>,
-    "risk_level": "<Critical or High or Medium or Low>",
-    "emotional_state": "<brief 5-10 word description>",
-    "key_concerns": ["<concern1>", "<concern2>"],
-    "confidence": <float between 0.0 and 1.0>
-}}
-
-CRITICAL: Detect sarcasm ("I'm fine" when struggling), minimization, hidden emotions, and consider conversation context."""
+            cache_key = AnalysisCache.make_key(text, cache_context)
+            cached = self.cache.get(cache_key, text, cache_context)
+            if cached is not None:
+                log.debug("⚡ Cache hit - skipping Gemini call")
+                return cached
+            
+            parts = [GEMINI_PROMPT_PREFIX]
+            if context:
+                parts.append(f"Previous conversation context:\n{context}\n")
+            parts.append(f'\n\nCurrent patient message: "{text}"\n\n')
+            parts.append(GEMINI_PROMPT_SUFFIX)
+            prompt = "".join(parts)
 
             data = {
                 "contents": [{
@@ -146,58 +581,52 @@ CRITICAL: Detect sarcasm ("I'm fine" when struggling), minimization, hidden emot
                 }],
                 "generationConfig": {
                     "temperature": 0.3,
-                    "maxOutputTokens": 1024
+                    "maxOutputTokens": 512,
+                    "responseMimeType": "application/json",
+                    "responseSchema": ANALYSIS_SCHEMA
                 }
             }
             
-            print(f"📡 Calling Gemini API: {self.api_url[:60]}...")
-            response = requests.post(self.api_url, json=data, timeout=30)
-            print(f"📡 Response status: {response.status_code}")
-            
-            if response.status_code != 200:
-                error_detail = response.text[:500]
-                print(f"❌ API Error Response: {error_detail}")
-                raise Exception(f"API returned {response.status_code}: {error_detail}")
-            
-            response.raise_for_status()
-            
-            result = response.json()
-            print(f"📡 Got JSON response")
-            
-            content = result['candidates'][0]['content']['parts'][0]['text']
-            print(f"📡 Raw content: {content[:200]}...")
-            
-            # Clean up response
-            content = content.replace('```json', '').replace('```', '').strip()
-            
-            # Extract JSON if embedded in text
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                content = json_match.group()
-            
-            print(f"📡 Cleaned content: {content[:200]}...")
+            log.debug("📡 Calling Gemini API: %.60s...", self.api_url)
+            body = json_dumps(data)
+            with self.session.post(self.api_url, data=body, stream=True, timeout=(3.05, 60)) as response:
+                log.debug("📡 Response status: %s", response.status_code)
+                
+                if response.status_code != 200:
+                    error_detail = response.text[:500]
+                    log.debug("❌ API Error Response: %s", error_detail)
+                    raise Exception(f"API returned {response.status_code}: {error_detail}")
+                
+                content = self._read_stream(response, on_partial)
+            log.debug("📡 Raw content: %.200s...", content)
             
-            analysis = json.loads(content)
-            analysis['analysis_timestamp'] = get_malaysia_time().isoformat()
+            # Structured output mode returns bare JSON, no fences to strip
+            analysis = json_loads(content)
+            analysis['analysis_timestamp'] = time.time_ns()
             analysis['ai_model'] = 'gemini-2.0-flash'
             
-            print(f"✅ Analysis complete: {analysis.get('risk_level')}")
+            log.debug("✅ Analysis complete: %s", analysis.get('risk_level'))
             
+            self.cache.put(cache_key, text, analysis, cache_context)
             return analysis
             
         except Exception as e:
-            print(f"❌ Exception in _gemini_analysis: {type(e).__name__}: {str(e)}")
+            log.debug("❌ Exception in _gemini_analysis: %s: %s", type(e).__name__, e)
             raise
     
-    def _simple_analysis(self, text):
+    def _simple_analysis(self, text, lowered=None):
         """Fallback simple analysis"""
-        words = text.lower().split()
-        positive = sum(1 for w in words if w.strip('.,!?') in self.positive_words)
-        negative = sum(1 for w in words if w.strip('.,!?') in self.negative_words)
+        if lowered is None:
+            lowered = text.lower()
+        tokens = lowered.translate(self._strip_punctuation).split()
+        # Count tokens in C, then only visit the (small) word lists
+        counts = Counter(tokens)
+        positive = sum(counts[word] for word in self.positive_set & counts.keys())
+        negative = sum(counts[word] for word in self.negative_set & counts.keys())
         
         score = 0
-        if len(words) > 0:
-            score = (positive - negative) / len(words) * 2
+        if len(tokens) > 0:
+            score = float(positive - negative) * 2 / len(tokens)
             score = max(-1.0, min(1.0, score))
         
         return {
@@ -211,124 +640,380 @@ CRITICAL: Detect sarcasm ("I'm fine" when struggling), minimization, hidden emot
             "emotional_state": "Basic analysis mode (AI unavailable)",
             "key_concerns": [],
             "confidence": 0.5,
-            "analysis_timestamp": get_malaysia_time().isoformat(),
+            "analysis_timestamp": time.time_ns(),
             "ai_model": "simple-fallback"
         }
 
+# Mock EMR records (static demo data, copied per database instance)
+MOCK_PATIENTS = {
+    "123456789012": {
+        "name": "Ahmad bin Ali",
+        "age": 35,
+        "gender": "Male",
+        "phone": "012-3456789",
+        "email": "ahmad.ali@email.com",
+        "medical_history": [
+            {"date": "2024-01-15", "diagnosis": "Hypertension", "doctor": "Dr. Lim"},
+            {"date": "2023-08-22", "diagnosis": "Type 2 Diabetes", "doctor": "Dr. Wong"},
+            {"date": "2023-03-10", "diagnosis": "Anxiety Disorder", "doctor": "Dr. Rahman"}
+        ],
+        "medications": [
+            {"name": "Amlodipine", "dosage": "5mg", "frequency": "Once daily"},
+            {"name": "Metformin", "dosage": "500mg", "frequency": "Twice daily"},
+            {"name": "Lorazepam", "dosage": "0.5mg", "frequency": "As needed"}
+        ],
+        "allergies": ["Penicillin", "Shellfish"],
+        "last_visit": "2024-01-15",
+        "mental_health_history": [
+            {"date": "2023-03-10", "condition": "Anxiety Disorder", "severity": "Moderate"}
+        ]
+    },
+    "987654321098": {
+        "name": "Siti Nurhaliza",
+        "age": 28,
+        "gender": "Female",
+        "phone": "013-9876543",
+        "email": "siti.nur@email.com",
+        "medical_history": [
+            {"date": "2024-02-20", "diagnosis": "Migraine", "doctor": "Dr. Tan"},
+            {"date": "2023-11-05", "diagnosis": "Depression", "doctor": "Dr. Ahmad"}
+        ],
+        "medications": [
+            {"name": "Sumatriptan", "dosage": "50mg", "frequency": "As needed"},
+            {"name": "Sertraline", "dosage": "50mg", "frequency": "Once daily"}
+        ],
+        "allergies": ["Aspirin"],
+        "last_visit": "2024-02-20",
+        "mental_health_history": [
+            {"date": "2023-11-05", "condition": "Major Depression", "severity": "Moderate to Severe"}
+        ]
+    },
+    "456789123456": {
+        "name": "Raj Kumar",
+        "age": 42,
+        "gender": "Male",
+        "phone": "014-5678901",
+        "email": "raj.kumar@email.com",
+        "medical_history": [
+            {"date": "2024-03-01", "diagnosis": "Chronic Back Pain", "doctor": "Dr. Lee"},
+            {"date": "2023-12-15", "diagnosis": "Insomnia", "doctor": "Dr. Chong"}
+        ],
+        "medications": [
+            {"name": "Ibuprofen", "dosage": "400mg", "frequency": "Three times daily"},
+            {"name": "Zolpidem", "dosage": "10mg", "frequency": "Before bedtime"}
+        ],
+        "allergies": ["None known"],
+        "last_visit": "2024-03-01",
+        "mental_health_history": [
+            {"date": "2023-12-15", "condition": "Sleep Disorder", "severity": "Mild"}
+        ]
+    }
+}
+
+class ChatLog:
+    """Chat transcript kept as parallel role/content columns
+    
+    Iterating yields the usual {"role", "content"} dicts, so the log can be
+    passed anywhere a message list is expected; the hot paths use the columns.
+    """
+    
+    def __init__(self, messages=()):
+        # The full transcript is kept for review and reports; only the context
+        # sent to the analyzer is bounded (see select_context_window)
+        self.roles = []
+        self.contents = []
+        self.user_mask = []
+        # Stored session records share the live log, so a doctor's session can
+        # read it while the patient's session appends; readers take snapshots
+        self._lock = threading.Lock()
+        for message in messages:
+            self.append(message['role'], message['content'])
+    
+    def append(self, role, content):
+        with self._lock:
+            self.roles.append(role)
+            self.contents.append(content)
+            self.user_mask.append(role == 'user')
+    
+    def pairs(self):
+        with self._lock:
+            return list(zip(self.roles, self.contents))
+    
+    def user_messages(self):
+        with self._lock:
+            return list(itertools.compress(self.contents, self.user_mask))
+    
+    def __len__(self):
+        return len(self.roles)
+    
+    def __iter__(self):
+        for role, content in self.pairs():
+            yield {"role": role, "content": content}
+    
+    def __reversed__(self):
+        for role, content in reversed(self.pairs()):
+            yield {"role": role, "content": content}
+
+class RiskLevel(IntEnum):
+    """Risk levels in order of severity; analyses store the label strings"""
+    NOT_ASSESSED = 0
+    LOW = 1
+    MEDIUM = 2
+    HIGH = 3
+    CRITICAL = 4
+    
+    @property
+    def label(self):
+        return self.name.replace('_', ' ').title()
+    
+    @classmethod
+    def from_label(cls, label):
+        """Level for an analysis label; anything unrecognised counts as not assessed"""
+        return cls.__members__.get(str(label).upper().replace(' ', '_'), cls.NOT_ASSESSED)
+
+RISK_FILTER_LEVELS = tuple(level.label for level in sorted(RiskLevel, reverse=True))
+
+@st.cache_data(show_spinner=False)
+def load_history_frames(ic_number):
+    """Medical and mental health history tables for a patient, built once"""
+    patient = MOCK_PATIENTS[ic_number]
+    return pd.DataFrame(patient['medical_history']), pd.DataFrame(patient['mental_health_history'])
+
 # Mock EMR Database
 class EMRDatabase:
     def __init__(self):
-        self.patients = {
-            "123456789012": {
-                "name": "Ahmad bin Ali",
-                "age": 35,
-                "gender": "Male",
-                "phone": "012-3456789",
-                "email": "ahmad.ali@email.com",
-                "medical_history": [
-                    {"date": "2024-01-15", "diagnosis": "Hypertension", "doctor": "Dr. Lim"},
-                    {"date": "2023-08-22", "diagnosis": "Type 2 Diabetes", "doctor": "Dr. Wong"},
-                    {"date": "2023-03-10", "diagnosis": "Anxiety Disorder", "doctor": "Dr. Rahman"}
-                ],
-                "medications": [
-                    {"name": "Amlodipine", "dosage": "5mg", "frequency": "Once daily"},
-                    {"name": "Metformin", "dosage": "500mg", "frequency": "Twice daily"},
-                    {"name": "Lorazepam", "dosage": "0.5mg", "frequency": "As needed"}
-                ],
-                "allergies": ["Penicillin", "Shellfish"],
-                "last_visit": "2024-01-15",
-                "mental_health_history": [
-                    {"date": "2023-03-10", "condition": "Anxiety Disorder", "severity": "Moderate"}
-                ]
-            },
-            "987654321098": {
-                "name": "Siti Nurhaliza",
-                "age": 28,
-                "gender": "Female",
-                "phone": "013-9876543",
-                "email": "siti.nur@email.com",
-                "medical_history": [
-                    {"date": "2024-02-20", "diagnosis": "Migraine", "doctor": "Dr. Tan"},
-                    {"date": "2023-11-05", "diagnosis": "Depression", "doctor": "Dr. Ahmad"}
-                ],
-                "medications": [
-                    {"name": "Sumatriptan", "dosage": "50mg", "frequency": "As needed"},
-                    {"name": "Sertraline", "dosage": "50mg", "frequency": "Once daily"}
-                ],
-                "allergies": ["Aspirin"],
-                "last_visit": "2024-02-20",
-                "mental_health_history": [
-                    {"date": "2023-11-05", "condition": "Major Depression", "severity": "Moderate to Severe"}
-                ]
-            },
-            "456789123456": {
-                "name": "Raj Kumar",
-                "age": 42,
-                "gender": "Male",
-                "phone": "014-5678901",
-                "email": "raj.kumar@email.com",
-                "medical_history": [
-                    {"date": "2024-03-01", "diagnosis": "Chronic Back Pain", "doctor": "Dr. Lee"},
-                    {"date": "2023-12-15", "diagnosis": "Insomnia", "doctor": "Dr. Chong"}
-                ],
-                "medications": [
-                    {"name": "Ibuprofen", "dosage": "400mg", "frequency": "Three times daily"},
-                    {"name": "Zolpidem", "dosage": "10mg", "frequency": "Before bedtime"}
-                ],
-                "allergies": ["None known"],
-                "last_visit": "2024-03-01",
-                "mental_health_history": [
-                    {"date": "2023-12-15", "condition": "Sleep Disorder", "severity": "Mild"}
-                ]
-            }
-        }
+        self.patients = copy.deepcopy(MOCK_PATIENTS)
+        # Identity plus a write counter let derived views be cached across reruns
+        self.key = uuid.uuid4().hex
+        self.version = 0
+        self.summary_df = self._build_summary()
+        # One database is shared by every browser session: writes hold the lock,
+        # and readers iterate snapshots taken under it
+        self.lock = threading.Lock()
+    
+    def _build_summary(self):
+        """One row per patient for the doctor's patient list, indexed by IC number"""
+        rows = []
+        for ic, patient in self.patients.items():
+            sessions = patient.get('chat_sessions', [])
+            risk_level = "Not Assessed"
+            if sessions:
+                risk_level = sessions[-1].get('analysis', {}).get('risk_level', 'Unknown')
+            rows.append({
+                "IC Number": ic,
+                "Name": patient['name'],
+                "Age": patient['age'],
+                "Gender": patient['gender'],
+                "Last Visit": patient['last_visit'],
+                "Mental Health Risk": risk_level,
+                "Chat Sessions": len(sessions)
+            })
+        
+        summary = pd.DataFrame(rows, index=list(self.patients))
+        summary["Mental Health Risk"] = pd.Categorical(summary["Mental Health Risk"], categories=RISK_FILTER_LEVELS + ("Unknown",))
+        return summary
     
     def get_patient(self, ic_number):
         return self.patients.get(ic_number)
     
+    def summary(self):
+        """Copy of the patient summary table, safe to filter while sessions write"""
+        with self.lock:
+            return self.summary_df.copy()
+    
+    def sessions(self, ic_number):
+        """Snapshot list of one patient's chat sessions"""
+        with self.lock:
+            return list(self.patients.get(ic_number, {}).get('chat_sessions', ()))
+    
+    def session_lists(self):
+        """Snapshot {ic: sessions list} for every patient with chat sessions"""
+        with self.lock:
+            return {
+                ic: list(patient['chat_sessions'])
+                for ic, patient in self.patients.items()
+                if 'chat_sessions' in patient
+            }
+    
+    def set_doctor_notes(self, ic_number, index, notes):
+        """Attach clinical notes to one stored session; False if it doesn't exist"""
+        with self.lock:
+            sessions = self.patients.get(ic_number, {}).get('chat_sessions')
+            if not sessions or not 0 <= index < len(sessions):
+                return False
+            sessions[index]['doctor_notes'] = notes
+            return True
+    
     def add_session_record(self, ic_number, session_data):
-        if ic_number in self.patients:
+        if ic_number not in self.patients:
+            return
+        risk_level = session_data.get('analysis', {}).get('risk_level', 'Unknown')
+        if RiskLevel.from_label(risk_level) is RiskLevel.NOT_ASSESSED:
+            risk_level = 'Unknown'
+        
+        with self.lock:
             if 'chat_sessions' not in self.patients[ic_number]:
                 self.patients[ic_number]['chat_sessions'] = []
-            self.patients[ic_number]['chat_sessions'].append(session_data)
+            sessions = self.patients[ic_number]['chat_sessions']
+            sessions.append(session_data)
+            
+            # Keep the summary row in step instead of rebuilding the table
+            self.summary_df.loc[ic_number, ["Mental Health Risk", "Chat Sessions"]] = (risk_level, len(sessions))
+            self.version += 1
+
+def merge_turn_analysis(aggregate, analysis, turns):
+    """Fold one turn's analysis into the aggregate of the previous `turns` turns
+    
+    Indicator counts accumulate, sentiment is a running mean and risk keeps the
+    most severe level seen; descriptive fields follow the latest turn.
+    """
+    merged = copy.deepcopy(analysis)
+    if aggregate is None:
+        return merged
+    
+    merged['sentiment_score'] = (aggregate['sentiment_score'] * turns + analysis['sentiment_score']) / (turns + 1)
+    for field in ('depression_indicators', 'anxiety_indicators', 'crisis_indicators'):
+        merged[field] = aggregate.get(field, 0) + analysis.get(field, 0)
+    merged['risk_level'] = max(aggregate['risk_level'], analysis['risk_level'], key=RiskLevel.from_label)
+    merged['key_concerns'] = list(dict.fromkeys(analysis.get('key_concerns', []) + aggregate.get('key_concerns', [])))[:5]
+    return merged
+
+# Risk banners and report text by analysis label (anything unrecognised uses "Low")
+SIDEBAR_RISK_BANNERS = {
+    "Critical": '<div class="risk-critical"><strong>⚠️ CRITICAL RISK DETECTED</strong><br>Immediate intervention required</div>',
+    "High": '<div class="risk-high"><strong>🔴 High Risk</strong><br>Professional support recommended</div>',
+    "Medium": '<div class="risk-medium"><strong>🟡 Medium Risk</strong><br>Monitor closely</div>',
+    "Low": '<div class="risk-low"><strong>🟢 Low Risk</strong><br>Continue support</div>'
+}
+REVIEW_RISK_BANNERS = {
+    "Critical": '<div class="risk-critical"><strong>⚠️ CRITICAL RISK</strong></div>',
+    "High": '<div class="risk-high"><strong>🔴 HIGH RISK</strong></div>',
+    "Medium": '<div class="risk-medium"><strong>🟡 MEDIUM RISK</strong></div>',
+    "Low": '<div class="risk-low"><strong>🟢 LOW RISK</strong></div>'
+}
+RISK_INTERPRETATIONS = {
+    "Critical": "CRITICAL: Immediate psychiatric intervention required. Patient may be at risk of self-harm.\n",
+    "High": "HIGH: Significant mental health concerns detected. Professional evaluation recommended within 1 week.\n",
+    "Medium": "MEDIUM: Moderate mental health indicators present. Monitoring and support recommended.\n",
+    "Low": "LOW: Minimal mental health risk indicators detected. Continue routine care.\n"
+}
+
+# Static recommendation content per risk level (anything unrecognised uses "Low");
+# the tuples are handed out as-is, so they must stay immutable
+RISK_RECOMMENDATIONS = {
+    "Critical": {
+        "immediate_action": "🚨 EMERGENCY - IMMEDIATE INTERVENTION REQUIRED",
+        "recommendations": (
+            "Contact emergency services (999) immediately if imminent danger",
+            "Activate crisis response team NOW",
+            "Do NOT leave patient alone",
+            "Immediate psychiatric evaluation required within 1 hour",
+            "Implement safety planning protocol",
+            "Contact patient's emergency contact immediately"
+        ),
+        "follow_up": "Continuous monitoring - within 1 hour"
+    },
+    "High": {
+        "immediate_action": "⚠️ URGENT - Mental health referral needed within 24-48 hours",
+        "recommendations": (
+            "Schedule urgent psychiatrist consultation within 48 hours",
+            "Consider immediate counseling/therapy referral",
+            "Review and adjust current medications if applicable",
+            "Implement daily check-ins (phone or in-person)",
+            "Provide crisis hotline numbers: Befrienders 03-76272929",
+            "Assess support system availability"
+        ),
+        "follow_up": "Within 24-48 hours, then every 2-3 days"
+    },
+    "Medium": {
+        "immediate_action": "📋 Schedule follow-up appointment within 1-2 weeks",
+        "recommendations": (
+            "Consider counseling or therapy referral",
+            "Discuss lifestyle modifications (sleep, exercise, diet)",
+            "Introduce stress management techniques",
+            "Evaluate sleep patterns and quality",
+            "Weekly check-ins via phone or video chat"
+        ),
+        "follow_up": "Within 1-2 weeks"
+    },
+    "Low": {
+        "immediate_action": "✅ Continue supportive care and monitoring",
+        "recommendations": (
+            "Maintain regular check-ups",
+            "Encourage healthy lifestyle habits",
+            "Provide mental health education resources",
+            "Keep communication channels open",
+            "Preventive mental wellness strategies"
+        ),
+        "follow_up": "Regular scheduled visits"
+    }
+}
+
+# Crisis keywords for safety override
+CRISIS_KEYWORDS = (
+    'suicide', 'suicidal', 'kill myself', 'end it all', 'die', 'dying',
+    'death wish', 'no reason to live', 'better off dead', 'harm myself',
+    'hurt myself', 'end my life', 'want to die', 'cant go on'
+)
 
 # Mental Health Analysis Engine with Gemini AI
 class MentalHealthAnalyzer:
     def __init__(self):
         self.sentiment_analyzer = GeminiSentimentAnalyzer()
         
-        # Crisis keywords for safety override
-        self.crisis_keywords = [
-            'suicide', 'suicidal', 'kill myself', 'end it all', 'die', 'dying',
-            'death wish', 'no reason to live', 'better off dead', 'harm myself',
-            'hurt myself', 'end my life', 'want to die', 'cant go on'
-        ]
+        # Shared across sessions, so new sessions don't rebuild the automaton
+        self.crisis_keywords = CRISIS_KEYWORDS
+        self._crisis_matcher = load_keyword_matcher(CRISIS_KEYWORDS)
+        self._recommendation_memo = OrderedDict()
     
-    def analyze_text(self, text, conversation_history=None):
+    def analyze_text(self, text, conversation_history=None, on_partial=None):
         """Analyze text using Gemini AI with conversation context"""
-        # Get AI analysis
-        analysis = self.sentiment_analyzer.analyze_sentiment(text, conversation_history)
-        
-        # Crisis keyword safety override
+        # Crisis keywords force Critical regardless, so don't wait on the API
         text_lower = text.lower()
-        crisis_count = sum(1 for keyword in self.crisis_keywords if keyword in text_lower)
-        
+        crisis_count = self._crisis_matcher.count(text_lower)
         if crisis_count > 0:
-            analysis['risk_level'] = "Critical"
-            analysis['crisis_indicators'] = max(analysis.get('crisis_indicators', 0), crisis_count)
-            if 'key_concerns' not in analysis:
-                analysis['key_concerns'] = []
-            analysis['key_concerns'].insert(0, "CRISIS KEYWORDS DETECTED - IMMEDIATE INTERVENTION REQUIRED")
+            return self._crisis_analysis(crisis_count)
         
-        return analysis
+        # Get AI analysis
+        return self.sentiment_analyzer.analyze_sentiment(text, conversation_history, on_partial, lowered=text_lower)
+    
+    def _crisis_analysis(self, crisis_count):
+        """Synthesized Critical result for messages containing crisis keywords"""
+        return {
+            "sentiment_score": -0.9,
+            "is_sarcastic": False,
+            "true_emotion": "crisis",
+            "depression_indicators": 5,
+            "anxiety_indicators": 5,
+            "crisis_indicators": crisis_count,
+            "risk_level": "Critical",
+            "emotional_state": "Crisis indicators detected",
+            "key_concerns": ["CRISIS KEYWORDS DETECTED - IMMEDIATE INTERVENTION REQUIRED"],
+            "confidence": 1.0,
+            "analysis_timestamp": time.time_ns(),
+            "ai_model": "keyword-override"
+        }
     
     def generate_recommendations(self, analysis_result, patient_history=None):
-        """Generate contextual recommendations based on AI analysis"""
+        """Generate contextual recommendations based on AI analysis
+        
+        Results are memoized on the analysis fields they depend on and shared
+        between callers, so treat them as read-only.
+        """
         risk_level = analysis_result.get("risk_level", "Low")
         emotional_state = analysis_result.get("emotional_state", "")
         key_concerns = analysis_result.get("key_concerns", [])
         is_sarcastic = analysis_result.get("is_sarcastic", False)
         
+        memo_key = (
+            risk_level, emotional_state, tuple(key_concerns), is_sarcastic,
+            analysis_result.get('true_emotion', 'unknown'), analysis_result.get('confidence', 0)
+        )
+        memoized = self._recommendation_memo.get(memo_key)
+        if memoized is not None:
+            self._recommendation_memo.move_to_end(memo_key)
+            return memoized
+        
         recommendations = {
             "immediate_action": "",
             "recommendations": [],
@@ -360,126 +1045,93 @@ class MentalHealthAnalyzer:
             recommendations["additional_notes"].append(f"Emotional state: {emotional_state}")
         
         # Risk-based recommendations
-        if risk_level == "Critical":
-            recommendations.update({
-                "immediate_action": "🚨 EMERGENCY - IMMEDIATE INTERVENTION REQUIRED",
-                "recommendations": [
-                    "Contact emergency services (999) immediately if imminent danger",
-                    "Activate crisis response team NOW",
-                    "Do NOT leave patient alone",
-                    "Immediate psychiatric evaluation required within 1 hour",
-                    "Implement safety planning protocol",
-                    "Contact patient's emergency contact immediately"
-                ],
-                "follow_up": "Continuous monitoring - within 1 hour"
-            })
-        elif risk_level == "High":
-            recommendations.update({
-                "immediate_action": "⚠️ URGENT - Mental health referral needed within 24-48 hours",
-                "recommendations": [
-                    "Schedule urgent psychiatrist consultation within 48 hours",
-                    "Consider immediate counseling/therapy referral",
-                    "Review and adjust current medications if applicable",
-                    "Implement daily check-ins (phone or in-person)",
-                    "Provide crisis hotline numbers: Befrienders 03-76272929",
-                    "Assess support system availability"
-                ],
-                "follow_up": "Within 24-48 hours, then every 2-3 days"
-            })
-        elif risk_level == "Medium":
-            recommendations.update({
-                "immediate_action": "📋 Schedule follow-up appointment within 1-2 weeks",
-                "recommendations": [
-                    "Consider counseling or therapy referral",
-                    "Discuss lifestyle modifications (sleep, exercise, diet)",
-                    "Introduce stress management techniques",
-                    "Evaluate sleep patterns and quality",
-                    "Weekly check-ins via phone or video chat"
-                ],
-                "follow_up": "Within 1-2 weeks"
-            })
-        else:  # Low risk
-            recommendations.update({
-                "immediate_action": "✅ Continue supportive care and monitoring",
-                "recommendations": [
-                    "Maintain regular check-ups",
-                    "Encourage healthy lifestyle habits",
-                    "Provide mental health education resources",
-                    "Keep communication channels open",
-                    "Preventive mental wellness strategies"
-                ],
-                "follow_up": "Regular scheduled visits"
-            })
+        template = RISK_RECOMMENDATIONS.get(risk_level, RISK_RECOMMENDATIONS["Low"])
+        recommendations["immediate_action"] = template["immediate_action"]
+        recommendations["recommendations"] = template["recommendations"]
+        recommendations["follow_up"] = template["follow_up"]
         
+        self._recommendation_memo[memo_key] = recommendations
+        if len(self._recommendation_memo) > 512:
+            self._recommendation_memo.popitem(last=False)
         return recommendations
 
+@st.cache_resource
+def load_emr_database():
+    """One EMR database per process, shared by every session"""
+    return EMRDatabase()
+
 # Initialize global objects
 if 'emr_db' not in st.session_state:
-    st.session_state.emr_db = EMRDatabase()
+    st.session_state.emr_db = load_emr_database()
 if 'analyzer' not in st.session_state:
+    # Per session: its analysis cache holds this patient's conversation
     st.session_state.analyzer = MentalHealthAnalyzer()
 
+# Custom CSS. It is re-emitted on every rerun because Streamlit removes any
+# element that a rerun does not render again
+APP_CSS = """
+<style>
+.main-header {
+    font-size: 3rem;
+    color: #1f77b4;
+    text-align: center;
+    margin-bottom: 2rem;
+}
+.risk-high {
+    background-color: #ffebee;
+    padding: 1rem;
+    border-left: 5px solid #f44336;
+    margin: 1rem 0;
+}
+.risk-medium {
+    background-color: #fff3e0;
+    padding: 1rem;
+    border-left: 5px solid #ff9800;
+    margin: 1rem 0;
+}
+.risk-low {
+    background-color: #e8f5e8;
+    padding: 1rem;
+    border-left: 5px solid #4caf50;
+    margin: 1rem 0;
+}
+.risk-critical {
+    background-color: #fce4ec;
+    padding: 1rem;
+    border-left: 5px solid #e91e63;
+    margin: 1rem 0;
+    animation: blink 1s linear infinite;
+}
+@keyframes blink {
+    0% { opacity: 1; }
+    50% { opacity: 0.5; }
+    100% { opacity: 1; }
+}
+.chat-message {
+    padding: 1.2rem;
+    margin: 0.8rem 0;
+    border-radius: 15px;
+    line-height: 1.6;
+    font-size: 1.05rem;
+}
+.user-message {
+    background: linear-gradient(135deg, #e3f2fd 0%, #bbdefb 100%);
+    margin-left: 3rem;
+    border: 1px solid #90caf9;
+    box-shadow: 0 2px 8px rgba(33, 150, 243, 0.1);
+}
+.bot-message {
+    background: linear-gradient(135deg, #f3e5f5 0%, #e1bee7 100%);
+    margin-right: 3rem;
+    border: 1px solid #ce93d8;
+    box-shadow: 0 2px 8px rgba(156, 39, 176, 0.1);
+}
+</style>
+"""
+
 def main():
     # Custom CSS
-    st.markdown("""
-    <style>
-    .main-header {
-        font-size: 3rem;
-        color: #1f77b4;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .risk-high {
-        background-color: #ffebee;
-        padding: 1rem;
-        border-left: 5px solid #f44336;
-        margin: 1rem 0;
-    }
-    .risk-medium {
-        background-color: #fff3e0;
-        padding: 1rem;
-        border-left: 5px solid #ff9800;
-        margin: 1rem 0;
-    }
-    .risk-low {
-        background-color: #e8f5e8;
-        padding: 1rem;
-        border-left: 5px solid #4caf50;
-        margin: 1rem 0;
-    }
-    .risk-critical {
-        background-color: #fce4ec;
-        padding: 1rem;
-        border-left: 5px solid #e91e63;
-        margin: 1rem 0;
-        animation: blink 1s linear infinite;
-    }
-    @keyframes blink {
-        0% { opacity: 1; }
-        50% { opacity: 0.5; }
-        100% { opacity: 1; }
-    }
-    .chat-message {
-        padding: 1.2rem;
-        margin: 0.8rem 0;
-        border-radius: 15px;
-        line-height: 1.6;
-        font-size: 1.05rem;
-    }
-    .user-message {
-        background: linear-gradient(135deg, #e3f2fd 0%, #bbdefb 100%);
-        margin-left: 3rem;
-        border: 1px solid #90caf9;
-        box-shadow: 0 2px 8px rgba(33, 150, 243, 0.1);
-    }
-    .bot-message {
-        background: linear-gradient(135deg, #f3e5f5 0%, #e1bee7 100%);
-        margin-right: 3rem;
-        border: 1px solid #ce93d8;
-        box-shadow: 0 2px 8px rgba(156, 39, 176, 0.1);
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(APP_CSS, unsafe_allow_html=True)
     
     # Sidebar navigation
     st.sidebar.title("🧠 MindBridge Navigation")
@@ -587,6 +1239,12 @@ def show_home_page():
     with col4:
         st.metric("🎯 Risk Assessments", "3,421")
 
+DEMO_PATIENT_INFO = "**Demo IC Numbers:**\n- 123456789012 (Ahmad bin Ali)\n- 987654321098 (Siti Nurhaliza)\n- 456789123456 (Raj Kumar)"
+DEMO_DOCTOR_INFO = "**Demo Credentials:**\n- Username: dr.lim, dr.wong, or dr.ahmad\n- Password: demo123"
+
+# Malaysian IC numbers are exactly 12 ASCII digits (str.isdigit also accepts other scripts)
+IC_NUMBER_RE = re.compile(r'\d{12}', re.ASCII)
+
 def show_patient_login():
     st.title("👤 Patient Login")
     st.write("Enter your Malaysian IC number to access your health records and mental health support.")
@@ -597,7 +1255,7 @@ def show_patient_login():
         submitted = st.form_submit_button("🔐 Login")
         
         if submitted:
-            if len(ic_number) != 12 or not ic_number.isdigit():
+            if not IC_NUMBER_RE.fullmatch(ic_number):
                 st.error("Please enter a valid 12-digit IC number")
             elif not consent_checkbox:
                 st.error("Please provide consent to proceed")
@@ -614,7 +1272,7 @@ def show_patient_login():
                     st.error("Patient record not found. Please contact your healthcare provider.")
     
     st.markdown("---")
-    st.info("**Demo IC Numbers:**\n- 123456789012 (Ahmad bin Ali)\n- 987654321098 (Siti Nurhaliza)\n- 456789123456 (Raj Kumar)")
+    st.info(DEMO_PATIENT_INFO)
 
 def show_doctor_login():
     st.title("👨‍⚕️ Healthcare Provider Login")
@@ -636,7 +1294,7 @@ def show_doctor_login():
                 st.error("Invalid credentials")
     
     st.markdown("---")
-    st.info("**Demo Credentials:**\n- Username: dr.lim, dr.wong, or dr.ahmad\n- Password: demo123")
+    st.info(DEMO_DOCTOR_INFO)
 
 def show_patient_profile():
     st.title("📋 My Health Profile")
@@ -648,30 +1306,28 @@ def show_patient_profile():
         
         with col1:
             st.subheader("👤 Personal Information")
-            st.write(f"**Name:** {patient_data['name']}")
-            st.write(f"**Age:** {patient_data['age']}")
-            st.write(f"**Gender:** {patient_data['gender']}")
-            st.write(f"**Phone:** {patient_data['phone']}")
-            st.write(f"**Email:** {patient_data['email']}")
-            st.write(f"**Last Visit:** {patient_data['last_visit']}")
+            st.markdown("\n\n".join([
+                f"**Name:** {patient_data['name']}",
+                f"**Age:** {patient_data['age']}",
+                f"**Gender:** {patient_data['gender']}",
+                f"**Phone:** {patient_data['phone']}",
+                f"**Email:** {patient_data['email']}",
+                f"**Last Visit:** {patient_data['last_visit']}"
+            ]))
         
         with col2:
             st.subheader("🩺 Medical Summary")
-            st.write("**Current Medications:**")
-            for med in patient_data['medications']:
-                st.write(f"- {med['name']} ({med['dosage']}) - {med['frequency']}")
-            
-            st.write("**Known Allergies:**")
-            for allergy in patient_data['allergies']:
-                st.write(f"- {allergy}")
+            medications = "\n".join(f"- {med['name']} ({med['dosage']}) - {med['frequency']}" for med in patient_data['medications'])
+            allergies = "\n".join(f"- {allergy}" for allergy in patient_data['allergies'])
+            st.markdown(f"**Current Medications:**\n\n{medications}\n\n**Known Allergies:**\n\n{allergies}")
+        
+        history_df, mh_df = load_history_frames(st.session_state.current_patient)
         
         st.subheader("📊 Recent Medical History")
-        history_df = pd.DataFrame(patient_data['medical_history'])
         st.dataframe(history_df, use_container_width=True)
         
         st.subheader("🧠 Mental Health History")
         if patient_data['mental_health_history']:
-            mh_df = pd.DataFrame(patient_data['mental_health_history'])
             st.dataframe(mh_df, use_container_width=True)
         else:
             st.info("No previous mental health records found.")
@@ -691,18 +1347,15 @@ def show_chat_interface():
     
     # Initialize chat history with a warmer greeting
     if 'chat_messages' not in st.session_state:
-        st.session_state.chat_messages = [
+        st.session_state.chat_messages = ChatLog([
             {"role": "assistant", "content": "Hi there 💙 I'm so glad you're here. This is your space to share whatever's on your mind, at your own pace. There's no pressure - just know that I'm here to listen and support you. How are you feeling today?"}
-        ]
+        ])
+        st.session_state.last_aggregate_analysis = None
+        st.session_state.aggregate_cursor = 0
     
-    # Display chat history with softer styling
+    # Chat history goes above the form, but is filled in after the send and
+    # clear handlers so a turn renders in the same run instead of a second one
     chat_container = st.container()
-    with chat_container:
-        for message in st.session_state.chat_messages:
-            if message["role"] == "user":
-                st.markdown(f'<div class="chat-message user-message"><strong>You:</strong> {message["content"]}</div>', unsafe_allow_html=True)
-            else:
-                st.markdown(f'<div class="chat-message bot-message">💙 {message["content"]}</div>', unsafe_allow_html=True)
     
     # Chat input
     # Chat input form (forms auto-clear on submit!)
@@ -722,21 +1375,33 @@ def show_chat_interface():
     # Handle send button
     if send_button:
         if user_input.strip():
-            # Add user message
-            st.session_state.chat_messages.append({"role": "user", "content": user_input})
+            # The log iterates as role/content dicts, the shape the analyzer expects;
+            # the message joins it after analysis so it is context for later turns only
+            conversation_history = st.session_state.chat_messages
+            
+            # Analyze message with AI, showing the risk read-out as it streams in
+            live_status = st.empty()
+            
+            def show_partial(fields):
+                risk = fields.get('risk_level', '…')
+                state = fields.get('emotional_state', '')
+                live_status.info(f"🔎 Reading your message… Risk: **{risk}** {state}")
             
-            # Pass conversation history for AI context
-            conversation_history = [
-                {"role": msg["role"], "content": msg["content"]} 
-                for msg in st.session_state.chat_messages
-            ]
+            analysis = st.session_state.analyzer.analyze_text(user_input, conversation_history, show_partial)
+            live_status.empty()
             
-            # Analyze message with AI
-            analysis = st.session_state.analyzer.analyze_text(user_input, conversation_history)
+            # Add user message
+            st.session_state.chat_messages.append("user", user_input)
+            
+            # Fold this turn into the running conversation analysis shown in the sidebar
+            st.session_state.last_aggregate_analysis = merge_turn_analysis(
+                st.session_state.last_aggregate_analysis, analysis, st.session_state.aggregate_cursor
+            )
+            st.session_state.aggregate_cursor += 1
             
             # Generate AI response
             ai_response = generate_ai_response(user_input, analysis)
-            st.session_state.chat_messages.append({"role": "assistant", "content": ai_response})
+            st.session_state.chat_messages.append("assistant", ai_response)
             
             # Save session data
             session_data = {
@@ -745,44 +1410,35 @@ def show_chat_interface():
                 "analysis": analysis
             }
             st.session_state.emr_db.add_session_record(st.session_state.current_patient, session_data)
-            
-            st.rerun()
     
     # Clear chat button (outside the form)
     col1, col2, col3 = st.columns([1, 1, 2])
     with col2:
         if st.button("🔄 Clear Chat"):
-            st.session_state.chat_messages = [
+            st.session_state.chat_messages = ChatLog([
                 {"role": "assistant", "content": "Hello! I'm here to support you today. How are you feeling right now?"}
-            ]
-            st.rerun()
+            ])
+            st.session_state.last_aggregate_analysis = None
+            st.session_state.aggregate_cursor = 0
+    
+    # Display chat history with softer styling, as one markdown element
+    chat_html = "\n".join(
+        f'<div class="chat-message user-message"><strong>You:</strong> {content}</div>' if role == "user"
+        else f'<div class="chat-message bot-message">💙 {content}</div>'
+        for role, content in st.session_state.chat_messages.pairs()
+    )
+    chat_container.markdown(chat_html, unsafe_allow_html=True)
     
     # Real-time analysis sidebar with Gemini AI insights
     if len(st.session_state.chat_messages) > 1:
         st.sidebar.subheader("📊 Real-time AI Analysis")
         
-        # Analyze all user messages
-        user_messages = [msg["content"] for msg in st.session_state.chat_messages if msg["role"] == "user"]
-        if user_messages:
-            combined_text = " ".join(user_messages)
-            
-            # Pass full conversation history
-            conversation_history = [
-                {"role": msg["role"], "content": msg["content"]} 
-                for msg in st.session_state.chat_messages
-            ]
-            analysis = st.session_state.analyzer.analyze_text(combined_text, conversation_history)
+        # Aggregate of every user turn, merged in as each message is sent
+        analysis = st.session_state.last_aggregate_analysis
+        if analysis is not None:
             
             # Risk level indicator
-            risk_level = analysis["risk_level"]
-            if risk_level == "Critical":
-                st.sidebar.markdown('<div class="risk-critical"><strong>⚠️ CRITICAL RISK DETECTED</strong><br>Immediate intervention required</div>', unsafe_allow_html=True)
-            elif risk_level == "High":
-                st.sidebar.markdown('<div class="risk-high"><strong>🔴 High Risk</strong><br>Professional support recommended</div>', unsafe_allow_html=True)
-            elif risk_level == "Medium":
-                st.sidebar.markdown('<div class="risk-medium"><strong>🟡 Medium Risk</strong><br>Monitor closely</div>', unsafe_allow_html=True)
-            else:
-                st.sidebar.markdown('<div class="risk-low"><strong>🟢 Low Risk</strong><br>Continue support</div>', unsafe_allow_html=True)
+            st.sidebar.markdown(SIDEBAR_RISK_BANNERS.get(analysis["risk_level"], SIDEBAR_RISK_BANNERS["Low"]), unsafe_allow_html=True)
             
             # Analysis metrics
             st.sidebar.metric("Sentiment Score", f"{analysis['sentiment_score']:.2f}")
@@ -816,22 +1472,16 @@ def show_chat_interface():
                 st.sidebar.info("ℹ️ Using basic analysis")
             
             # Debug info (helps troubleshoot)
-            with st.sidebar.expander("🔧 Debug Info"):
-                st.write(f"AI Model: {ai_model}")
-                st.write(f"API Key Present: {'Yes' if st.session_state.analyzer.sentiment_analyzer.api_key else 'No'}")
-                st.write(f"Using Fallback: {st.session_state.analyzer.sentiment_analyzer.use_fallback}")
-                if st.session_state.analyzer.sentiment_analyzer.api_key:
-                    st.write(f"API Key (first 20 chars): {st.session_state.analyzer.sentiment_analyzer.api_key[:20]}...")
+            if debug_enabled():
+                with st.sidebar.expander("🔧 Debug Info"):
+                    st.write(f"AI Model: {ai_model}")
+                    st.write(f"API Key Present: {'Yes' if st.session_state.analyzer.sentiment_analyzer.api_key else 'No'}")
+                    st.write(f"Using Fallback: {st.session_state.analyzer.sentiment_analyzer.use_fallback}")
+                    if st.session_state.analyzer.sentiment_analyzer.api_key:
+                        st.write(f"API Key (first 20 chars): {st.session_state.analyzer.sentiment_analyzer.api_key[:20]}...")
 
-def generate_ai_response(user_input, analysis):
-    """Generate contextual AI responses based on user input and analysis"""
-    
-    risk_level = analysis["risk_level"]
-    sentiment = analysis["sentiment_score"]
-    
-    # Crisis response
-    if risk_level == "Critical":
-        return """I hear you, and I'm really concerned about what you're going through right now. Your life matters, and you deserve support and care. 💙
+# Static chat replies, selected by risk level (and sentiment within a level)
+CRISIS_RESPONSE = """I hear you, and I'm really concerned about what you're going through right now. Your life matters, and you deserve support and care. 💙
 
 I know things might feel overwhelming, but please know that you don't have to face this alone. There are people who want to help:
 
@@ -845,15 +1495,13 @@ I know things might feel overwhelming, but please know that you don't have to fa
 
 I care about your wellbeing, and I want you to get the support you deserve. Will you reach out to one of these resources? You're worth it."""
 
-    # High risk response
-    elif risk_level == "High":
-        responses = [
-            "Thank you for trusting me with what you're feeling. I can hear that you're really struggling right now, and that takes courage to share.",
-            "I'm really glad you're here and talking about this. What you're experiencing sounds incredibly difficult.",
-            "Your feelings are completely valid, and I want you to know that you're not alone in this."
-        ]
-        base_response = random.choice(responses)
-        return f"""{base_response}
+HIGH_RISK_OPENERS = (
+    "Thank you for trusting me with what you're feeling. I can hear that you're really struggling right now, and that takes courage to share.",
+    "I'm really glad you're here and talking about this. What you're experiencing sounds incredibly difficult.",
+    "Your feelings are completely valid, and I want you to know that you're not alone in this."
+)
+
+HIGH_RISK_FOLLOW_UP = """
 
 💜 **What might help right now:**
 • Talking to a mental health professional can make a real difference - they're trained to help with exactly what you're going through
@@ -863,10 +1511,7 @@ I care about your wellbeing, and I want you to get the support you deserve. Will
 
 Would you like to talk more about what's been weighing on you? I'm here to listen, without judgment. 💙"""
 
-    # Medium risk response
-    elif risk_level == "Medium":
-        if sentiment < -0.2:
-            return """I can hear that things feel heavy right now. It's completely okay to not be okay - we all have these moments, and reaching out like you're doing takes real strength. 💙
+MEDIUM_RISK_LOW_MOOD_RESPONSE = """I can hear that things feel heavy right now. It's completely okay to not be okay - we all have these moments, and reaching out like you're doing takes real strength. 💙
 
 **Some gentle suggestions that might help:**
 • Take a few slow, deep breaths (in through your nose, out through your mouth)
@@ -877,8 +1522,8 @@ Would you like to talk more about what's been weighing on you? I'm here to liste
 Remember, you don't have to tackle everything at once. Just this moment, just this breath.
 
 What do you think would feel helpful right now? I'm here to listen. 🌸"""
-        else:
-            return """Thank you for opening up and sharing this with me. I'm here to listen and support you through whatever you're experiencing, at your own pace. 💜
+
+MEDIUM_RISK_RESPONSE = """Thank you for opening up and sharing this with me. I'm here to listen and support you through whatever you're experiencing, at your own pace. 💜
 
 **Things that might be helpful to explore:**
 • Acknowledge what you're feeling, without judging yourself for it - all feelings are valid
@@ -888,10 +1533,7 @@ What do you think would feel helpful right now? I'm here to listen. 🌸"""
 
 Is there anything specific that's been on your mind that you'd like to talk through together?"""
 
-    # Low risk/neutral response
-    else:
-        if sentiment > 0.1:
-            return """It's wonderful to hear you're doing okay! 💚 Taking time to check in on your mental health shows real self-awareness and care for yourself.
+LOW_RISK_POSITIVE_RESPONSE = """It's wonderful to hear you're doing okay! 💚 Taking time to check in on your mental health shows real self-awareness and care for yourself.
 
 **Ways to keep nurturing your wellbeing:**
 • Move your body in ways that feel good - dancing, walking, stretching
@@ -900,8 +1542,8 @@ Is there anything specific that's been on your mind that you'd like to talk thro
 • Make time for things that bring you joy
 
 Even on good days, it's great to talk things through. Is there anything on your mind you'd like to explore? 🌟"""
-        else:
-            return """Thank you for being here and sharing with me. Whatever you're feeling right now is okay - there's no pressure, no judgment, just a safe space to talk. 💙
+
+LOW_RISK_RESPONSE = """Thank you for being here and sharing with me. Whatever you're feeling right now is okay - there's no pressure, no judgment, just a safe space to talk. 💙
 
 **Sometimes it helps to:**
 • Put words to what's sitting in your heart or mind
@@ -911,6 +1553,45 @@ Even on good days, it's great to talk things through. Is there anything on your
 
 What would feel most supportive for you to talk about right now? I'm here, and I'm listening. 🌸"""
 
+def generate_ai_response(user_input, analysis):
+    """Generate contextual AI responses based on user input and analysis"""
+    
+    risk_level = analysis["risk_level"]
+    sentiment = analysis["sentiment_score"]
+    
+    # Crisis response
+    if risk_level == "Critical":
+        return CRISIS_RESPONSE
+
+    # High risk response
+    elif risk_level == "High":
+        return random.choice(HIGH_RISK_OPENERS) + HIGH_RISK_FOLLOW_UP
+
+    # Medium risk response
+    elif risk_level == "Medium":
+        if sentiment < -0.2:
+            return MEDIUM_RISK_LOW_MOOD_RESPONSE
+        else:
+            return MEDIUM_RISK_RESPONSE
+
+    # Low risk/neutral response
+    else:
+        if sentiment > 0.1:
+            return LOW_RISK_POSITIVE_RESPONSE
+        else:
+            return LOW_RISK_RESPONSE
+
+REPORT_PAGE_SIZE = 10
+
+def visible_sessions(sessions, page_key):
+    """(index, session) for the newest pages of sessions, with a button to reveal older ones"""
+    pages = st.session_state.get(page_key, 1)
+    start = max(len(sessions) - pages * REPORT_PAGE_SIZE, 0)
+    if start > 0 and st.button(f"⬆️ Load older sessions ({start} hidden)", key=f"{page_key}_older"):
+        st.session_state[page_key] = pages + 1
+        st.rerun()
+    return enumerate(itertools.islice(sessions, start, None), start)
+
 def show_patient_reports():
     st.title("📊 My Mental Health Reports")
     
@@ -919,7 +1600,9 @@ def show_patient_reports():
     if 'chat_sessions' in patient_data and patient_data['chat_sessions']:
         st.subheader("📈 Session History")
         
-        for i, session in enumerate(patient_data['chat_sessions']):
+        page_key = f"report_pages_{st.session_state.current_patient}"
+        sessions = st.session_state.emr_db.sessions(st.session_state.current_patient)
+        for i, session in visible_sessions(sessions, page_key):
             with st.expander(f"Session {i+1} - {session['timestamp'][:10]}"):
                 
                 # Session analysis
@@ -958,79 +1641,59 @@ def show_patient_reports():
                     for note in recommendations['additional_notes']:
                         st.info(note)
                 
-                # Download report
-                if st.button(f"📄 Download Report {i+1}"):
-                    report_data = generate_patient_report(session, patient_data)
-                    st.download_button(
-                        label="Download Report",
-                        data=report_data,
-                        file_name=f"mental_health_report_{i+1}.txt",
-                        mime="text/plain"
-                    )
+                # Download report (built once per stored session)
+                st.download_button(
+                    label=f"📄 Download Report {i+1}",
+                    data=cached_patient_report(
+                        st.session_state.emr_db.key, st.session_state.current_patient,
+                        session['timestamp'], session, patient_data
+                    ),
+                    file_name=f"mental_health_report_{i+1}.txt",
+                    mime="text/plain",
+                    key=f"dl_{st.session_state.current_patient}_{i}"
+                )
     else:
         st.info("No chat sessions found. Start a conversation in the Mental Health Chat to generate reports.")
 
+RISK_BG = {
+    "Critical": 'background-color: #ffcdd2',
+    "High": 'background-color: #ffe0b2',
+    "Medium": 'background-color: #fff9c4',
+    "Low": 'background-color: #c8e6c9'
+}
+RISK_BG_DEFAULT = 'background-color: #f5f5f5'
+
 def show_doctor_patient_list():
     st.title("👥 Patient Management Dashboard")
     
-    # Create patient summary
-    patients_summary = []
-    for ic, patient in st.session_state.emr_db.patients.items():
-        last_session = None
-        risk_level = "Not Assessed"
-        
-        if 'chat_sessions' in patient and patient['chat_sessions']:
-            last_session = patient['chat_sessions'][-1]
-            risk_level = last_session.get('analysis', {}).get('risk_level', 'Unknown')
-        
-        patients_summary.append({
-            "IC Number": ic,
-            "Name": patient['name'],
-            "Age": patient['age'],
-            "Gender": patient['gender'],
-            "Last Visit": patient['last_visit'],
-            "Mental Health Risk": risk_level,
-            "Chat Sessions": len(patient.get('chat_sessions', []))
-        })
-    
-    df = pd.DataFrame(patients_summary)
+    df = st.session_state.emr_db.summary()
     
     # Filters
     col1, col2, col3 = st.columns(3)
     with col1:
-        risk_filter = st.selectbox("Filter by Risk Level", 
-                                 ["All", "Critical", "High", "Medium", "Low", "Not Assessed"])
+        risk_filter = st.selectbox("Filter by Risk Level", ("All",) + RISK_FILTER_LEVELS)
     with col2:
         gender_filter = st.selectbox("Filter by Gender", ["All", "Male", "Female"])
     with col3:
         min_sessions = st.number_input("Min Chat Sessions", min_value=0, value=0)
     
-    # Apply filters
-    filtered_df = df.copy()
+    # Apply filters as one combined mask
+    mask = df["Chat Sessions"] >= min_sessions
     if risk_filter != "All":
-        filtered_df = filtered_df[filtered_df["Mental Health Risk"] == risk_filter]
+        mask &= df["Mental Health Risk"] == risk_filter
     if gender_filter != "All":
-        filtered_df = filtered_df[filtered_df["Gender"] == gender_filter]
-    filtered_df = filtered_df[filtered_df["Chat Sessions"] >= min_sessions]
+        mask &= df["Gender"] == gender_filter
+    filtered_df = df[mask]
     
     # Display patient list
     st.subheader(f"📋 Patient List ({len(filtered_df)} patients)")
     
-    # Color code based on risk level
-    def color_risk_level(val):
-        if val == "Critical":
-            return 'background-color: #ffcdd2'
-        elif val == "High":
-            return 'background-color: #ffe0b2'
-        elif val == "Medium":
-            return 'background-color: #fff9c4'
-        elif val == "Low":
-            return 'background-color: #c8e6c9'
-        else:
-            return 'background-color: #f5f5f5'
-    
-    styled_df = filtered_df.style.applymap(color_risk_level, subset=['Mental Health Risk'])
-    st.dataframe(styled_df, use_container_width=True)
+    # Color code based on risk level, one Series.map per render
+    styled_df = filtered_df.style.apply(
+        lambda col: col.astype(object).map(RISK_BG).fillna(RISK_BG_DEFAULT),
+        subset=['Mental Health Risk']
+    )
+    st.dataframe(styled_df, use_container_width=True, hide_index=True)
     
     # Patient detail view
     st.subheader("🔍 Patient Detail View")
@@ -1079,112 +1742,149 @@ def show_doctor_patient_list():
                 for concern in analysis['key_concerns']:
                     st.write(f"• {concern}")
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_analytics(db_key, version, _db):
+    """Session frame, risk counts and summary stats for one EMR version"""
+    session_lists = _db.session_lists()
+    # One flat typed frame, then a single-pass reduction over its columns
+    records = (
+        (
+            session['timestamp'][:10],
+            analysis.get('risk_level', 'Unknown'),
+            analysis.get('sentiment_score', 0),
+            analysis.get('depression_indicators', 0),
+            analysis.get('anxiety_indicators', 0)
+        )
+        for sessions in session_lists.values()
+        for session in sessions
+        for analysis in (session.get('analysis', {}),)
+    )
+    all_sessions = pd.DataFrame.from_records(
+        records, columns=['date', 'risk_level', 'sentiment', 'depression_indicators', 'anxiety_indicators']
+    ).astype({
+        'date': 'datetime64[s]',
+        'risk_level': 'category',
+        'sentiment': 'float32',
+        'depression_indicators': 'int16',
+        'anxiety_indicators': 'int16'
+    })
+    
+    # Count risk levels
+    level_counts = all_sessions['risk_level'].value_counts()
+    risk_counts = {level: int(level_counts.get(level, 0)) for level in ("Critical", "High", "Medium", "Low")}
+    risk_counts["Not Assessed"] = len(_db.patients) - len(session_lists)
+    
+    stats = None
+    if len(all_sessions):
+        summarize = _summarize_sessions_numpy
+        if len(all_sessions) >= SESSION_STATS_JIT_MIN_ROWS:
+            summarize = load_session_stats_kernel()
+        values = summarize(
+            all_sessions['sentiment'].to_numpy(),
+            all_sessions['depression_indicators'].to_numpy(),
+            all_sessions['anxiety_indicators'].to_numpy()
+        )
+        stats = dict(zip(SESSION_STAT_FIELDS, map(float, values)))
+    return all_sessions, risk_counts, stats
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def build_analytics_figures(db_key, version, _all_sessions, _risk_counts):
+    """Dashboard figures for one EMR version, reused as-is across reruns"""
+    px = load_plotly()
+    figures = {}
+    
+    risk_df = pd.DataFrame(list(_risk_counts.items()), columns=['Risk Level', 'Count'])
+    figures['pie'] = px.pie(risk_df, values='Count', names='Risk Level', 
+                            color_discrete_map={
+                                'Critical': '#e91e63',
+                                'High': '#f44336', 
+                                'Medium': '#ff9800',
+                                'Low': '#4caf50',
+                                'Not Assessed': '#9e9e9e'
+                            })
+    figures['hist'] = px.histogram(x=_all_sessions['sentiment'], nbins=20, 
+                                   title="Distribution of Sentiment Scores")
+    
+    figures['line'] = None
+    if len(_all_sessions) > 1:
+        daily_sentiment = _all_sessions.groupby('date')['sentiment'].mean().reset_index()
+        figures['line'] = px.line(daily_sentiment, x='date', y='sentiment',
+                                  title="Average Daily Sentiment Score")
+    
+    figures['scatter'] = px.scatter(_all_sessions, x='depression_indicators', y='anxiety_indicators',
+                                    color='risk_level',
+                                    title="Depression vs Anxiety Indicators")
+    return figures
+
 def show_analytics_dashboard():
     st.title("📊 Mental Health Analytics Dashboard")
     
-    # Generate analytics data
-    all_sessions = []
-    risk_counts = {"Critical": 0, "High": 0, "Medium": 0, "Low": 0, "Not Assessed": 0}
-    
-    for ic, patient in st.session_state.emr_db.patients.items():
-        if 'chat_sessions' in patient:
-            for session in patient['chat_sessions']:
-                analysis = session.get('analysis', {})
-                all_sessions.append({
-                    'date': session['timestamp'][:10],
-                    'risk_level': analysis.get('risk_level', 'Unknown'),
-                    'sentiment': analysis.get('sentiment_score', 0),
-                    'depression_indicators': analysis.get('depression_indicators', 0),
-                    'anxiety_indicators': analysis.get('anxiety_indicators', 0)
-                })
-        else:
-            risk_counts["Not Assessed"] += 1
-    
-    # Count risk levels
-    for session in all_sessions:
-        risk_level = session['risk_level']
-        if risk_level in risk_counts:
-            risk_counts[risk_level] += 1
+    patients = st.session_state.emr_db.patients
+    all_sessions, risk_counts, stats = build_analytics(
+        st.session_state.emr_db.key, st.session_state.emr_db.version, st.session_state.emr_db
+    )
     
     # Dashboard metrics
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total Patients", len(st.session_state.emr_db.patients))
+        st.metric("Total Patients", len(patients))
     with col2:
         st.metric("Total Sessions", len(all_sessions))
     with col3:
         high_risk = risk_counts["Critical"] + risk_counts["High"]
         st.metric("High Risk Patients", high_risk)
     with col4:
-        avg_sentiment = np.mean([s['sentiment'] for s in all_sessions]) if all_sessions else 0
+        avg_sentiment = stats['sentiment_mean'] if len(all_sessions) else 0
         st.metric("Avg Sentiment", f"{avg_sentiment:.2f}")
     
     # Charts
-    if all_sessions:
-        if PLOTLY_AVAILABLE:
+    if len(all_sessions):
+        px = load_plotly()
+        if px is not None:
+            figures = build_analytics_figures(
+                st.session_state.emr_db.key, st.session_state.emr_db.version, all_sessions, risk_counts
+            )
             col1, col2 = st.columns(2)
         
             with col1:
                 # Risk level distribution
                 st.subheader("🎯 Risk Level Distribution")
-                risk_df = pd.DataFrame(list(risk_counts.items()), columns=['Risk Level', 'Count'])
-                fig_pie = px.pie(risk_df, values='Count', names='Risk Level', 
-                               color_discrete_map={
-                                   'Critical': '#e91e63',
-                                   'High': '#f44336', 
-                                   'Medium': '#ff9800',
-                                   'Low': '#4caf50',
-                                   'Not Assessed': '#9e9e9e'
-                               })
-                st.plotly_chart(fig_pie, use_container_width=True)
+                st.plotly_chart(figures['pie'], use_container_width=True)
         
             with col2:
                 # Sentiment distribution
                 st.subheader("😊 Sentiment Score Distribution")
-                sentiment_data = [s['sentiment'] for s in all_sessions]
-                fig_hist = px.histogram(x=sentiment_data, nbins=20, 
-                                      title="Distribution of Sentiment Scores")
-                st.plotly_chart(fig_hist, use_container_width=True)
+                st.plotly_chart(figures['hist'], use_container_width=True)
         
             # Time series analysis
-            if len(all_sessions) > 1:
+            if figures['line'] is not None:
                 st.subheader("📈 Mental Health Trends Over Time")
-                sessions_df = pd.DataFrame(all_sessions)
-                sessions_df['date'] = pd.to_datetime(sessions_df['date'])
-                daily_sentiment = sessions_df.groupby('date')['sentiment'].mean().reset_index()
-            
-                fig_line = px.line(daily_sentiment, x='date', y='sentiment',
-                                 title="Average Daily Sentiment Score")
-                st.plotly_chart(fig_line, use_container_width=True)
+                st.plotly_chart(figures['line'], use_container_width=True)
         
             # Indicator correlation
             st.subheader("🔗 Mental Health Indicators")
-            indicators_df = pd.DataFrame(all_sessions)
         
             col1, col2 = st.columns(2)
             with col1:
-                fig_scatter = px.scatter(indicators_df, x='depression_indicators', y='anxiety_indicators',
-                                       color='risk_level',
-                                       title="Depression vs Anxiety Indicators")
-                st.plotly_chart(fig_scatter, use_container_width=True)
+                st.plotly_chart(figures['scatter'], use_container_width=True)
             
             with col2:
                 # Summary statistics
                 st.subheader("📋 Summary Statistics")
                 st.write("**Depression Indicators:**")
-                st.write(f"- Average: {np.mean([s['depression_indicators'] for s in all_sessions]):.1f}")
-                st.write(f"- Max: {max([s['depression_indicators'] for s in all_sessions])}")
+                st.write(f"- Average: {stats['depression_mean']:.1f}")
+                st.write(f"- Max: {stats['depression_max']:.0f}")
                 
                 st.write("**Anxiety Indicators:**")
-                st.write(f"- Average: {np.mean([s['anxiety_indicators'] for s in all_sessions]):.1f}")
-                st.write(f"- Max: {max([s['anxiety_indicators'] for s in all_sessions])}")
+                st.write(f"- Average: {stats['anxiety_mean']:.1f}")
+                st.write(f"- Max: {stats['anxiety_max']:.0f}")
                 
                 st.write("**Sentiment Scores:**")
-                sentiments = [s['sentiment'] for s in all_sessions]
-                st.write(f"- Average: {np.mean(sentiments):.2f}")
-                st.write(f"- Range: {min(sentiments):.2f} to {max(sentiments):.2f}")
+                st.write(f"- Average: {stats['sentiment_mean']:.2f}")
+                st.write(f"- Range: {stats['sentiment_min']:.2f} to {stats['sentiment_max']:.2f}")
         else:
             # Fallback to basic charts or tables when Plotly is not available
+            st.warning("Plotly not available. Charts will be disabled.")
             st.subheader("📊 Data Summary (Charts unavailable)")
             col1, col2 = st.columns(2)
         
@@ -1195,10 +1895,9 @@ def show_analytics_dashboard():
         
             with col2:
                 st.subheader("😊 Sentiment Statistics")
-                sentiment_data = [s['sentiment'] for s in all_sessions]
-                st.write(f"Average Sentiment: {np.mean(sentiment_data):.2f}")
-                st.write(f"Min Sentiment: {min(sentiment_data):.2f}")
-                st.write(f"Max Sentiment: {max(sentiment_data):.2f}")
+                st.write(f"Average Sentiment: {stats['sentiment_mean']:.2f}")
+                st.write(f"Min Sentiment: {stats['sentiment_min']:.2f}")
+                st.write(f"Max Sentiment: {stats['sentiment_max']:.2f}")
     
     else:
         st.info("No chat session data available for analytics. Patients need to complete chat sessions first.")
@@ -1206,20 +1905,18 @@ def show_analytics_dashboard():
 def show_doctor_reports():
     st.title("📝 Mental Health Report Review")
     
-    # Get all patients with chat sessions
-    patients_with_sessions = []
-    for ic, patient in st.session_state.emr_db.patients.items():
-        if 'chat_sessions' in patient and patient['chat_sessions']:
-            patients_with_sessions.append((ic, patient['name']))
+    # Get all patients with chat sessions, from the maintained summary table
+    summary = st.session_state.emr_db.summary()
+    ic_to_name = summary.loc[summary["Chat Sessions"] > 0, "Name"].to_dict()
     
-    if not patients_with_sessions:
+    if not ic_to_name:
         st.info("No patient reports available. Patients need to complete chat sessions first.")
         return
     
     # Patient selection
     selected_patient = st.selectbox("Select Patient", 
-                                  options=[ic for ic, name in patients_with_sessions],
-                                  format_func=lambda x: next(name for ic, name in patients_with_sessions if ic == x))
+                                  options=list(ic_to_name),
+                                  format_func=ic_to_name.__getitem__)
     
     if selected_patient:
         patient_data = st.session_state.emr_db.get_patient(selected_patient)
@@ -1234,133 +1931,180 @@ def show_doctor_reports():
             st.write(f"**Total Sessions:** {len(patient_data['chat_sessions'])}")
             st.write(f"**Last Visit:** {patient_data['last_visit']}")
         with col3:
-            latest_analysis = patient_data['chat_sessions'][-1].get('analysis', {})
-            risk_level = latest_analysis.get('risk_level', 'Unknown')
+            latest_session = patient_data['chat_sessions'][-1]
+            risk_level = latest_session.get('analysis', {}).get('risk_level', 'Unknown')
             st.write(f"**Current Risk:** {risk_level}")
-            st.write(f"**Last Session:** {patient_data['chat_sessions'][-1]['timestamp'][:10]}")
+            st.write(f"**Last Session:** {latest_session['timestamp'][:10]}")
         
-        # Session reports
-        for i, session in enumerate(patient_data['chat_sessions']):
-            with st.expander(f"📅 Session {i+1} - {session['timestamp'][:16]}"):
-                
-                analysis = session.get('analysis', {})
-                messages = session.get('messages', [])
-                
-                # Analysis summary
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.subheader("🎯 Risk Assessment")
-                    risk_level = analysis.get('risk_level', 'Unknown')
-                    
-                    if risk_level == "Critical":
-                        st.markdown('<div class="risk-critical"><strong>⚠️ CRITICAL RISK</strong></div>', unsafe_allow_html=True)
-                    elif risk_level == "High":
-                        st.markdown('<div class="risk-high"><strong>🔴 HIGH RISK</strong></div>', unsafe_allow_html=True)
-                    elif risk_level == "Medium":
-                        st.markdown('<div class="risk-medium"><strong>🟡 MEDIUM RISK</strong></div>', unsafe_allow_html=True)
-                    else:
-                        st.markdown('<div class="risk-low"><strong>🟢 LOW RISK</strong></div>', unsafe_allow_html=True)
-                    
-                    st.metric("Sentiment Score", f"{analysis.get('sentiment_score', 0):.2f}")
-                    st.metric("Depression Indicators", analysis.get('depression_indicators', 0))
-                    st.metric("Anxiety Indicators", analysis.get('anxiety_indicators', 0))
-                    if analysis.get('crisis_indicators', 0) > 0:
-                        st.error(f"⚠️ Crisis Keywords Detected: {analysis.get('crisis_indicators', 0)}")
-                    
-                    # AI insights
-                    if analysis.get('is_sarcastic'):
-                        st.warning(f"⚠️ Sarcasm Detected: {analysis.get('true_emotion')}")
-                    
-                    confidence = analysis.get('confidence', 0)
-                    if confidence > 0:
-                        st.info(f"AI Confidence: {confidence:.0%}")
-                
-                with col2:
-                    st.subheader("💡 Clinical Recommendations")
-                    recommendations = st.session_state.analyzer.generate_recommendations(analysis, patient_data)
-                    
-                    st.write(f"**Immediate Action:** {recommendations['immediate_action']}")
-                    st.write("**Recommendations:**")
-                    for rec in recommendations['recommendations']:
-                        st.write(f"• {rec}")
-                    st.write(f"**Follow-up Timeline:** {recommendations['follow_up']}")
-                    
-                    if recommendations.get('additional_notes'):
-                        st.write("**Additional Notes:**")
-                        for note in recommendations['additional_notes']:
-                            st.info(note)
-                
-                # Show key concerns if available
-                key_concerns = analysis.get('key_concerns', [])
-                if key_concerns:
-                    st.subheader("🎯 AI-Identified Concerns")
-                    for concern in key_concerns:
-                        st.write(f"• {concern}")
-                
-                # Chat transcript
-                st.subheader("💬 Session Transcript")
-                user_messages = [msg['content'] for msg in messages if msg['role'] == 'user']
-                if user_messages:
-                    transcript_text = "\n\n".join([f"Patient: {msg}" for msg in user_messages])
-                    st.text_area("Patient Messages", transcript_text, height=200, disabled=True, key=f"transcript_{selected_patient}_{i}")
-
-                # Doctor notes section
-                st.subheader("📝 Clinical Notes")
-                
-                # Initialize session state for this session's notes if it doesn't exist
-                notes_key = f"doctor_notes_{selected_patient}_{i}"
-                if notes_key not in st.session_state:
-                    # Load existing notes from session data if they exist
-                    st.session_state[notes_key] = session.get('doctor_notes', '')
-                
-                # Display existing saved notes if any
-                if session.get('doctor_notes'):
-                    st.info(f"**Saved Notes:** {session.get('doctor_notes')}")
-                
-                doctor_notes = st.text_area(f"Add/Edit clinical notes for session {i+1}:", 
-                                          value=st.session_state[notes_key],
-                                          key=f"notes_input_{selected_patient}_{i}", 
-                                          height=100)
-                
-                if st.button(f"💾 Save Notes for Session {i+1}", key=f"save_{selected_patient}_{i}"):
-                    # Save notes to the session data in EMR
-                    if selected_patient in st.session_state.emr_db.patients:
-                        if 'chat_sessions' in st.session_state.emr_db.patients[selected_patient]:
-                            st.session_state.emr_db.patients[selected_patient]['chat_sessions'][i]['doctor_notes'] = doctor_notes
-                            st.session_state[notes_key] = doctor_notes
-                            st.success("✅ Clinical notes saved successfully!")
-                            st.rerun()
-                        else:
-                            st.error("Error: Session not found")
-                    else:
-                        st.error("Error: Patient not found")
-                
-                # Generate comprehensive report
-                if st.button(f"📄 Generate Full Report for Session {i+1}", key=f"report_{selected_patient}_{i}"):
-                    # Use saved doctor notes if they exist, otherwise use current input
-                    report_notes = session.get('doctor_notes', doctor_notes)
-                    full_report = generate_comprehensive_report(session, patient_data, report_notes)
-                    st.download_button(
-                        label="📥 Download Comprehensive Report",
-                        data=full_report,
-                        file_name=f"comprehensive_report_{patient_data['name'].replace(' ', '_')}_session_{i+1}.txt",
-                        mime="text/plain",
-                        key=f"download_{selected_patient}_{i}"
-                    )
+        # Session reports; each renders as a fragment, so its buttons rerun only that session
+        sessions = st.session_state.emr_db.sessions(selected_patient)
+        for i, session in visible_sessions(sessions, f"review_pages_{selected_patient}"):
+            show_session_review(i, session, patient_data, selected_patient)
+
+@st.fragment
+def show_session_review(i, session, patient_data, selected_patient):
+    """One session's review panel: analysis, recommendations, notes and report"""
+    with st.expander(f"📅 Session {i+1} - {session['timestamp'][:16]}"):
+        
+        analysis = session.get('analysis', {})
+        messages = session.get('messages', ChatLog())
+        
+        # Analysis summary
+        col1, col2 = st.columns(2)
+        with col1:
+            st.subheader("🎯 Risk Assessment")
+            risk_level = analysis.get('risk_level', 'Unknown')
+            st.markdown(REVIEW_RISK_BANNERS.get(risk_level, REVIEW_RISK_BANNERS["Low"]), unsafe_allow_html=True)
+            
+            st.metric("Sentiment Score", f"{analysis.get('sentiment_score', 0):.2f}")
+            st.metric("Depression Indicators", analysis.get('depression_indicators', 0))
+            st.metric("Anxiety Indicators", analysis.get('anxiety_indicators', 0))
+            if analysis.get('crisis_indicators', 0) > 0:
+                st.error(f"⚠️ Crisis Keywords Detected: {analysis.get('crisis_indicators', 0)}")
+            
+            # AI insights
+            if analysis.get('is_sarcastic'):
+                st.warning(f"⚠️ Sarcasm Detected: {analysis.get('true_emotion')}")
+            
+            confidence = analysis.get('confidence', 0)
+            if confidence > 0:
+                st.info(f"AI Confidence: {confidence:.0%}")
+        
+        with col2:
+            st.subheader("💡 Clinical Recommendations")
+            recommendations = st.session_state.analyzer.generate_recommendations(analysis, patient_data)
+            
+            st.write(f"**Immediate Action:** {recommendations['immediate_action']}")
+            st.write("**Recommendations:**")
+            for rec in recommendations['recommendations']:
+                st.write(f"• {rec}")
+            st.write(f"**Follow-up Timeline:** {recommendations['follow_up']}")
+            
+            if recommendations.get('additional_notes'):
+                st.write("**Additional Notes:**")
+                for note in recommendations['additional_notes']:
+                    st.info(note)
+        
+        # Show key concerns if available
+        key_concerns = analysis.get('key_concerns', [])
+        if key_concerns:
+            st.subheader("🎯 AI-Identified Concerns")
+            for concern in key_concerns:
+                st.write(f"• {concern}")
+        
+        # Chat transcript
+        st.subheader("💬 Session Transcript")
+        user_messages = messages.user_messages()
+        if user_messages:
+            transcript_text = "\n\n".join([f"Patient: {msg}" for msg in user_messages])
+            st.text_area("Patient Messages", transcript_text, height=200, disabled=True, key=f"transcript_{selected_patient}_{i}")
+
+        # Doctor notes section
+        st.subheader("📝 Clinical Notes")
+        
+        # Initialize session state for this session's notes if it doesn't exist
+        notes_key = f"doctor_notes_{selected_patient}_{i}"
+        report_key = f"full_report_{selected_patient}_{i}"
+        if notes_key not in st.session_state:
+            # Load existing notes from session data if they exist
+            st.session_state[notes_key] = session.get('doctor_notes', '')
+        
+        # Display existing saved notes if any
+        if session.get('doctor_notes'):
+            st.info(f"**Saved Notes:** {session.get('doctor_notes')}")
+        
+        # Notes and both actions submit together, so editing notes
+        # doesn't rerun anything until one of the buttons is pressed
+        with st.form(key=f"session_form_{selected_patient}_{i}"):
+            doctor_notes = st.text_area(f"Add/Edit clinical notes for session {i+1}:", 
+                                      value=st.session_state[notes_key],
+                                      key=f"notes_input_{selected_patient}_{i}", 
+                                      height=100)
+            save_clicked = st.form_submit_button(f"💾 Save Notes for Session {i+1}")
+            report_clicked = st.form_submit_button(f"📄 Generate Full Report for Session {i+1}")
+        
+        if save_clicked:
+            # Save notes to the session data in EMR
+            if selected_patient not in st.session_state.emr_db.patients:
+                st.error("Error: Patient not found")
+            elif st.session_state.emr_db.set_doctor_notes(selected_patient, i, doctor_notes):
+                st.session_state[notes_key] = doctor_notes
+                # A previously generated report no longer has the current notes
+                st.session_state.pop(report_key, None)
+                st.success("✅ Clinical notes saved successfully!")
+                st.rerun()
+            else:
+                st.error("Error: Session not found")
+        
+        # Generate comprehensive report; the encoded body is kept with the
+        # notes and transcript length it was built from, so reruns and repeated
+        # clicks reuse it until the notes change or the patient chats on
+        if report_clicked:
+            # Use saved doctor notes if they exist, otherwise use current input
+            report_notes = session.get('doctor_notes', doctor_notes)
+            report_state = (report_notes, len(session.get('messages', ())))
+            cached_report = st.session_state.get(report_key)
+            if cached_report is None or cached_report[0] != report_state:
+                report_body = comprehensive_report_body(session, patient_data, report_notes)
+                st.session_state[report_key] = (report_state, report_body.encode('utf-8'))
+        
+        if report_key in st.session_state:
+            # The generated-at line is stamped per render, not cached with the body
+            st.download_button(
+                label="📥 Download Comprehensive Report",
+                data=st.session_state[report_key][1] + comprehensive_report_footer().encode('utf-8'),
+                file_name=f"comprehensive_report_{patient_data['name'].replace(' ', '_')}_session_{i+1}.txt",
+                mime="text/plain",
+                key=f"download_{selected_patient}_{i}"
+            )
+
+# Fixed closing sections of the patient and clinical reports
+PATIENT_REPORT_FOOTER = """
+IMPORTANT NOTES
+---------------
+- This report is generated by AI and should be reviewed by a healthcare professional
+- If you're experiencing a mental health crisis, contact emergency services (999) immediately
+- For ongoing support, contact Befrienders: 03-76272929
+- Regular follow-up with your healthcare provider is recommended
+
+PRIVACY NOTICE
+--------------
+This report contains confidential medical information. Keep it secure and only share with authorized healthcare providers.
+
+Generated by MindBridge AI Mental Health Platform
+Powered by Gemini AI
+"""
+
+CLINICAL_REPORT_NOTICES = """
+DISCLAIMER
+----------
+This report is generated using AI technology and should be used as a clinical decision support tool only. 
+All recommendations should be reviewed and validated by qualified mental health professionals.
+The AI analysis is based on text communication patterns and may not capture all relevant clinical factors.
+
+CONFIDENTIALITY NOTICE
+----------------------
+This document contains privileged and confidential information intended solely for authorized healthcare providers.
+Distribution should be limited to personnel directly involved in patient care.
+Ensure compliance with local privacy and data protection regulations.
+
+"""
 
 def generate_patient_report(session, patient_data):
     """Generate a patient-friendly report"""
     
     analysis = session.get('analysis', {})
-    timestamp = session.get('timestamp', '')
+    date_str, time_str = split_timestamp(session.get('timestamp', ''))
+    emotional_state = analysis.get('emotional_state')
+    key_concerns = analysis.get('key_concerns')
     
-    report = f"""
+    parts = [f"""
 MINDBRIDGE MENTAL HEALTH REPORT
 ===============================
 
 Patient: {patient_data['name']}
-Date: {timestamp[:10]}
-Time: {timestamp[11:16]}
+Date: {date_str}
+Time: {time_str}
 
 ASSESSMENT SUMMARY
 ------------------
@@ -1369,63 +2113,55 @@ Sentiment Score: {analysis.get('sentiment_score', 0):.2f}
 Depression Indicators: {analysis.get('depression_indicators', 0)}
 Anxiety Indicators: {analysis.get('anxiety_indicators', 0)}
 AI Confidence: {analysis.get('confidence', 0):.0%}
-"""
+"""]
 
     if analysis.get('is_sarcastic'):
-        report += f"\nNote: Communication style detected - True emotion: {analysis.get('true_emotion')}\n"
+        parts.append(f"\nNote: Communication style detected - True emotion: {analysis.get('true_emotion')}\n")
     
-    if analysis.get('emotional_state'):
-        report += f"Emotional State: {analysis.get('emotional_state')}\n"
+    if emotional_state:
+        parts.append(f"Emotional State: {emotional_state}\n")
     
-    if analysis.get('key_concerns'):
-        report += "\nKey Concerns Identified:\n"
-        for concern in analysis['key_concerns']:
-            report += f"- {concern}\n"
+    if key_concerns:
+        parts.append("\nKey Concerns Identified:\n")
+        parts.extend(f"- {concern}\n" for concern in key_concerns)
     
-    report += """
+    parts.append("""
 RECOMMENDATIONS
 ---------------
-"""
+""")
     
     recommendations = st.session_state.analyzer.generate_recommendations(analysis)
-    report += f"Immediate Action: {recommendations['immediate_action']}\n\n"
-    report += "Suggested Next Steps:\n"
-    for i, rec in enumerate(recommendations['recommendations'], 1):
-        report += f"{i}. {rec}\n"
+    parts.append(f"Immediate Action: {recommendations['immediate_action']}\n\n")
+    parts.append("Suggested Next Steps:\n")
+    parts.extend(f"{i}. {rec}\n" for i, rec in enumerate(recommendations['recommendations'], 1))
     
-    report += f"\nFollow-up Timeline: {recommendations['follow_up']}\n"
+    parts.append(f"\nFollow-up Timeline: {recommendations['follow_up']}\n")
     
-    if recommendations.get('additional_notes'):
-        report += "\nAdditional Notes:\n"
-        for note in recommendations['additional_notes']:
-            report += f"- {note}\n"
+    additional_notes = recommendations.get('additional_notes')
+    if additional_notes:
+        parts.append("\nAdditional Notes:\n")
+        parts.extend(f"- {note}\n" for note in additional_notes)
     
-    report += """
-IMPORTANT NOTES
----------------
-- This report is generated by AI and should be reviewed by a healthcare professional
-- If you're experiencing a mental health crisis, contact emergency services (999) immediately
-- For ongoing support, contact Befrienders: 03-76272929
-- Regular follow-up with your healthcare provider is recommended
-
-PRIVACY NOTICE
---------------
-This report contains confidential medical information. Keep it secure and only share with authorized healthcare providers.
-
-Generated by MindBridge AI Mental Health Platform
-Powered by Gemini AI
-"""
+    parts.append(PATIENT_REPORT_FOOTER)
     
-    return report
+    return "".join(parts)
 
-def generate_comprehensive_report(session, patient_data, doctor_notes=""):
-    """Generate a comprehensive clinical report"""
+@st.cache_data(show_spinner=False, max_entries=256)
+def cached_patient_report(db_key, ic_number, timestamp, _session, _patient_data):
+    """Patient report for one stored session; sessions don't change once written"""
+    return generate_patient_report(_session, _patient_data)
+
+def comprehensive_report_body(session, patient_data, doctor_notes=""):
+    """Clinical report up to the timestamped footer; safe to cache"""
     
     analysis = session.get('analysis', {})
-    messages = session.get('messages', [])
-    timestamp = session.get('timestamp', '')
+    messages = session.get('messages', ChatLog())
+    date_str, time_str = split_timestamp(session.get('timestamp', ''))
+    risk_level = analysis.get('risk_level', 'Unknown')
+    emotional_state = analysis.get('emotional_state')
+    key_concerns = analysis.get('key_concerns')
     
-    report = f"""
+    parts = [f"""
 COMPREHENSIVE MENTAL HEALTH ASSESSMENT REPORT
 ============================================
 
@@ -1434,132 +2170,111 @@ PATIENT INFORMATION
 Name: {patient_data['name']}
 Age: {patient_data['age']}
 Gender: {patient_data['gender']}
-Assessment Date: {timestamp[:10]}
-Assessment Time: {timestamp[11:16]}
+Assessment Date: {date_str}
+Assessment Time: {time_str}
 
 MEDICAL HISTORY SUMMARY
 -----------------------
 Last Medical Visit: {patient_data['last_visit']}
 
 Current Medications:
-"""
+"""]
     
-    for med in patient_data['medications']:
-        report += f"- {med['name']} {med['dosage']} ({med['frequency']})\n"
+    parts.extend(f"- {med['name']} {med['dosage']} ({med['frequency']})\n" for med in patient_data['medications'])
     
-    report += f"\nKnown Allergies: {', '.join(patient_data['allergies'])}\n"
+    parts.append(f"\nKnown Allergies: {', '.join(patient_data['allergies'])}\n")
     
     if patient_data['mental_health_history']:
-        report += "\nPrevious Mental Health History:\n"
-        for mh in patient_data['mental_health_history']:
-            report += f"- {mh['date']}: {mh['condition']} ({mh['severity']})\n"
+        parts.append("\nPrevious Mental Health History:\n")
+        parts.extend(f"- {mh['date']}: {mh['condition']} ({mh['severity']})\n" for mh in patient_data['mental_health_history'])
     
-    report += f"""
+    parts.append(f"""
 
 AI ANALYSIS RESULTS (Powered by Gemini AI)
 -------------------------------------------
-Overall Risk Assessment: {analysis.get('risk_level', 'Unknown')}
+Overall Risk Assessment: {risk_level}
 Sentiment Analysis Score: {analysis.get('sentiment_score', 0):.3f}
 Depression Risk Indicators: {analysis.get('depression_indicators', 0)}
 Anxiety Risk Indicators: {analysis.get('anxiety_indicators', 0)}
 Crisis Risk Indicators: {analysis.get('crisis_indicators', 0)}
 AI Confidence Level: {analysis.get('confidence', 0):.0%}
-"""
+""")
 
     if analysis.get('is_sarcastic'):
-        report += f"\n⚠️ SARCASM DETECTED: Patient may be masking true emotions\n"
-        report += f"True Emotional State: {analysis.get('true_emotion', 'Unknown')}\n"
+        parts.append(f"\n⚠️ SARCASM DETECTED: Patient may be masking true emotions\n")
+        parts.append(f"True Emotional State: {analysis.get('true_emotion', 'Unknown')}\n")
     
-    if analysis.get('emotional_state'):
-        report += f"\nEmotional State Assessment: {analysis.get('emotional_state')}\n"
+    if emotional_state:
+        parts.append(f"\nEmotional State Assessment: {emotional_state}\n")
     
-    if analysis.get('key_concerns'):
-        report += "\nAI-Identified Key Concerns:\n"
-        for concern in analysis['key_concerns']:
-            report += f"• {concern}\n"
+    if key_concerns:
+        parts.append("\nAI-Identified Key Concerns:\n")
+        parts.extend(f"• {concern}\n" for concern in key_concerns)
     
-    report += """
+    parts.append("""
 
 RISK INTERPRETATION
 -------------------
-"""
+""")
     
-    risk_level = analysis.get('risk_level', 'Unknown')
-    if risk_level == "Critical":
-        report += "CRITICAL: Immediate psychiatric intervention required. Patient may be at risk of self-harm.\n"
-    elif risk_level == "High":
-        report += "HIGH: Significant mental health concerns detected. Professional evaluation recommended within 1 week.\n"
-    elif risk_level == "Medium":
-        report += "MEDIUM: Moderate mental health indicators present. Monitoring and support recommended.\n"
-    else:
-        report += "LOW: Minimal mental health risk indicators detected. Continue routine care.\n"
+    parts.append(RISK_INTERPRETATIONS.get(risk_level, RISK_INTERPRETATIONS["Low"]))
     
     # Clinical recommendations
     recommendations = st.session_state.analyzer.generate_recommendations(analysis, patient_data)
     
-    report += f"""
+    parts.append(f"""
 
 CLINICAL RECOMMENDATIONS
 ------------------------
 Immediate Action Required: {recommendations['immediate_action']}
 
 Recommended Interventions:
-"""
+""")
     
-    for i, rec in enumerate(recommendations['recommendations'], 1):
-        report += f"{i}. {rec}\n"
+    parts.extend(f"{i}. {rec}\n" for i, rec in enumerate(recommendations['recommendations'], 1))
     
-    report += f"\nFollow-up Timeline: {recommendations['follow_up']}\n"
+    parts.append(f"\nFollow-up Timeline: {recommendations['follow_up']}\n")
     
-    if recommendations.get('additional_notes'):
-        report += "\nAdditional Clinical Notes:\n"
-        for note in recommendations['additional_notes']:
-            report += f"• {note}\n"
+    additional_notes = recommendations.get('additional_notes')
+    if additional_notes:
+        parts.append("\nAdditional Clinical Notes:\n")
+        parts.extend(f"• {note}\n" for note in additional_notes)
     
     # Patient communication analysis
-    user_messages = [msg['content'] for msg in messages if msg['role'] == 'user']
+    user_messages = messages.user_messages()
     if user_messages:
-        report += f"""
+        # Joining on spaces never merges words, so one split of the transcript
+        # gives the same total as splitting each message
+        all_text = " ".join(user_messages).lower()
+        message_count = len(user_messages)
+        parts.append(f"""
 
 COMMUNICATION ANALYSIS
 ----------------------
-Total Patient Messages: {len(user_messages)}
-Average Message Length: {np.mean([len(msg.split()) for msg in user_messages]):.1f} words
+Total Patient Messages: {message_count}
+Average Message Length: {len(all_text.split()) / message_count:.1f} words
 
 Key Themes Identified:
-"""
-        
-        # Simple keyword analysis for themes
-        all_text = " ".join(user_messages).lower()
-        themes = []
+""")
         
-        if any(word in all_text for word in ['sad', 'depressed', 'down', 'hopeless']):
-            themes.append("Depressive symptoms")
-        if any(word in all_text for word in ['anxious', 'worried', 'nervous', 'panic']):
-            themes.append("Anxiety symptoms")
-        if any(word in all_text for word in ['sleep', 'tired', 'fatigue', 'insomnia']):
-            themes.append("Sleep disturbances")
-        if any(word in all_text for word in ['work', 'job', 'career', 'stress']):
-            themes.append("Work-related stress")
-        if any(word in all_text for word in ['family', 'relationship', 'partner']):
-            themes.append("Relationship concerns")
+        # Simple keyword analysis for themes, one pass over the transcript
+        themes = load_theme_matcher(REPORT_THEMES).themes_in(all_text)
         
         if themes:
-            for theme in themes:
-                report += f"- {theme}\n"
+            parts.extend(f"- {theme}\n" for theme in themes)
         else:
-            report += "- General mental health discussion\n"
+            parts.append("- General mental health discussion\n")
     
     # Doctor's clinical notes
     if doctor_notes.strip():
-        report += f"""
+        parts.append(f"""
 
 CLINICAL NOTES
 --------------
 {doctor_notes}
-"""
+""")
     
-    report += f"""
+    parts.append(f"""
 
 TECHNICAL DETAILS
 -----------------
@@ -1568,25 +2283,17 @@ Assessment Method: Natural Language Processing + AI Sentiment Analysis
 AI Model: {analysis.get('ai_model', 'Unknown')}
 Confidence Level: {analysis.get('confidence', 0):.0%}
 Data Quality: {'Good' if len(user_messages) > 2 else 'Limited'}
+""")
+    parts.append(CLINICAL_REPORT_NOTICES)
+    
+    return "".join(parts)
 
-DISCLAIMER
-----------
-This report is generated using AI technology and should be used as a clinical decision support tool only. 
-All recommendations should be reviewed and validated by qualified mental health professionals.
-The AI analysis is based on text communication patterns and may not capture all relevant clinical factors.
-
-CONFIDENTIALITY NOTICE
-----------------------
-This document contains privileged and confidential information intended solely for authorized healthcare providers.
-Distribution should be limited to personnel directly involved in patient care.
-Ensure compliance with local privacy and data protection regulations.
-
-Report Generated: {get_malaysia_time().strftime('%Y-%m-%d %H:%M:%S')}
+def comprehensive_report_footer():
+    """Closing lines of the clinical report, stamped with the current time"""
+    return f"""Report Generated: {get_malaysia_time().strftime('%Y-%m-%d %H:%M:%S')}
 Generated by: MindBridge AI Mental Health Platform v2.0
 Powered by: Google Gemini AI
 """
-    
-    return report
 
 if __name__ == "__main__":
     main()
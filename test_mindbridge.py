@@ -0,0 +1,186 @@
+import logging
+import warnings
+
+import numpy as np
+import pytest
+import requests
+
+warnings.filterwarnings("ignore")
+logging.disable(logging.WARNING)
+
+import mindbridge as mb  # noqa: E402  (runs the app script in bare mode)
+
+CRISIS_PHRASES = [
+    "i want to die",
+    "i wish i had died",
+    "suicides everywhere",
+    "i keep thinking about suicide",
+    "i'm going to kill myself",
+    "sometimes i think about killing myself... no, kill myself",
+    "i feel suicidal",
+    "everyone would be better off dead without me",
+    "there's no reason to live",
+    "i just want to end it all",
+    "i can't take it, i want to end my life",
+    "i cant go on like this",
+    "I Want To Die",
+]
+
+SAFE_PHRASES = [
+    "i'm fine, had a great day",
+    "work was stressful but i'm coping",
+]
+
+
+@pytest.fixture(params=[True, False], ids=["automaton", "fallback"])
+def crisis_matcher(request, monkeypatch):
+    if request.param and not mb.AHOCORASICK_AVAILABLE:
+        pytest.skip("pyahocorasick not installed")
+    monkeypatch.setattr(mb, "AHOCORASICK_AVAILABLE", request.param)
+    return mb.KeywordMatcher(mb.CRISIS_KEYWORDS)
+
+
+def baseline_count(text):
+    text_lower = text.lower()
+    return sum(1 for keyword in mb.CRISIS_KEYWORDS if keyword in text_lower)
+
+
+@pytest.mark.parametrize("text", CRISIS_PHRASES)
+def test_crisis_phrases_are_detected(crisis_matcher, text):
+    assert crisis_matcher.count(text.lower()) >= 1
+
+
+@pytest.mark.parametrize("text", CRISIS_PHRASES + SAFE_PHRASES)
+def test_crisis_count_matches_substring_checks(crisis_matcher, text):
+    assert crisis_matcher.count(text.lower()) == baseline_count(text)
+
+
+@pytest.mark.parametrize("text", SAFE_PHRASES)
+def test_safe_phrases_are_not_flagged(crisis_matcher, text):
+    assert crisis_matcher.count(text.lower()) == 0
+
+
+@pytest.mark.parametrize("text", ["i wish i had died", "suicides everywhere"])
+def test_crisis_override_forces_critical(text):
+    analysis = mb.MentalHealthAnalyzer().analyze_text(text)
+    assert analysis["risk_level"] == "Critical"
+    assert analysis["crisis_indicators"] >= 1
+
+
+class ConstantEmbedder:
+    """Maps every text to the same unit vector, so any two texts look identical"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text, normalize_embeddings=True):
+        self.calls += 1
+        return np.ones(4, dtype=np.float32) / 2
+
+
+A_TEXT = "i have been feeling really low and tired all week"
+B_TEXT = "i have been feeling very low and tired all this week"
+
+
+def test_similarity_tier_is_scoped_to_context():
+    cache = mb.AnalysisCache(embedder=ConstantEmbedder())
+    cache.put(cache.make_key(A_TEXT, "patient a"), A_TEXT, {"key_concerns": ["patient a"]}, "patient a")
+
+    assert cache.get(cache.make_key(B_TEXT, "patient b"), B_TEXT, "patient b") is None
+    assert cache.get(cache.make_key(B_TEXT, "patient a"), B_TEXT, "patient a") == {"key_concerns": ["patient a"]}
+
+
+def test_embedding_waits_for_a_possible_match():
+    embedder = ConstantEmbedder()
+    cache = mb.AnalysisCache(embedder=embedder)
+
+    assert cache.get(cache.make_key(A_TEXT, "ctx"), A_TEXT, "ctx") is None
+    cache.put(cache.make_key(A_TEXT, "ctx"), A_TEXT, {"risk_level": "Low"}, "ctx")
+    cache.put(cache.make_key("ok"), "ok", {"risk_level": "Low"})
+    assert cache.get(cache.make_key("ok!"), "ok!") is None
+    assert cache.get(cache.make_key(B_TEXT, "other"), B_TEXT, "other") is None
+    assert embedder.calls == 0
+
+    # Query and stored entry are embedded once there is something to compare
+    assert cache.get(cache.make_key(B_TEXT, "ctx"), B_TEXT, "ctx") == {"risk_level": "Low"}
+    assert embedder.calls == 2
+
+
+class TimeoutSession:
+    def __init__(self):
+        self.timeouts = []
+
+    def post(self, url, data=None, timeout=None):
+        self.timeouts.append(timeout)
+        raise requests.Timeout("embedding timed out")
+
+
+def test_embedding_timeout_falls_back_to_exact_tier():
+    session = TimeoutSession()
+    cache = mb.AnalysisCache(embedder=mb.GeminiEmbedder(session, "test-key"))
+    key = cache.make_key(A_TEXT, "ctx")
+
+    cache.put(key, A_TEXT, {"risk_level": "Low"}, "ctx")
+    assert session.timeouts == []
+
+    assert cache.get(cache.make_key(B_TEXT, "ctx"), B_TEXT, "ctx") is None
+    assert session.timeouts == [(2, 3)]
+    assert cache.get(key, A_TEXT, "ctx") == {"risk_level": "Low"}
+
+
+def test_chat_log_keeps_full_transcript_and_bounds_context():
+    log = mb.ChatLog()
+    for n in range(300):
+        log.append("user", f"message {n}")
+        log.append("assistant", f"reply {n}")
+
+    assert len(log) == 600
+    assert log.user_messages()[0] == "message 0"
+
+    window = mb.select_context_window(log)
+    assert 0 < len(window) < len(log)
+    assert window[-1] == {"role": "assistant", "content": "reply 299"}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeGeminiSession:
+    def __init__(self):
+        self.prompts = []
+
+    def post(self, url, data=None, stream=False, timeout=None):
+        self.prompts.append(mb.json_loads(data)["contents"][0]["parts"][0]["text"])
+        return FakeResponse()
+
+
+def test_chat_turns_hit_the_cache_on_the_last_exchange(monkeypatch):
+    analyzer = mb.GeminiSentimentAnalyzer()
+    analyzer.use_fallback = False
+    analyzer.api_url = "https://example.invalid"
+    analyzer.session = FakeGeminiSession()
+    analyzer.cache = mb.AnalysisCache(embedder=ConstantEmbedder())
+    monkeypatch.setattr(analyzer, "_read_stream", lambda response, on_partial=None: mb.json_dumps({"risk_level": "Low"}))
+
+    log = mb.ChatLog([{"role": "assistant", "content": "How are you feeling today?"}])
+    for text in (A_TEXT, A_TEXT, A_TEXT, B_TEXT):
+        # Same order as the send handler: analyze, then record the turn
+        analysis = analyzer._gemini_analysis(text, log)
+        assert analysis["risk_level"] == "Low"
+        log.append("user", text)
+        log.append("assistant", "Thank you for sharing that with me.")
+
+    # Turn 1 and 2 follow different exchanges; turn 3 repeats turn 2 exactly
+    # and turn 4 is a near-duplicate after the same exchange
+    assert len(analyzer.session.prompts) == 2
+    # Only the near-duplicate had a candidate to compare against
+    assert analyzer.cache.embedder.calls == 2
+    first_context = analyzer.session.prompts[0].split("Current patient message")[0]
+    assert A_TEXT not in first_context